@@ -0,0 +1,62 @@
+"""
+Updates 50 sensors on different stops concurrently against a stand-in API server on a local
+port and reports the update time, executor jobs, threads and TCP connections per round.
+
+    python bench/bench_async_update.py [sensors] [server delay in seconds]
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload # noqa: E402
+
+ROUNDS = 3
+
+
+async def run_rounds(module, hass, api, sensors, label):
+    """Updates all sensors ROUNDS times, each round requesting every stop again."""
+    for round_number in range(ROUNDS):
+        for sensor in sensors:
+            sensor._next_refresh = None
+            sensor._fetcher._fetched_at = None
+        requests, jobs = len(api.requests), hass.executor_jobs
+        threads = threading.active_count()
+        start = time.perf_counter()
+        await asyncio.gather(*(sensor.async_update() for sensor in sensors))
+        elapsed = time.perf_counter() - start
+        print(
+            f"{label:<8} round {round_number + 1}: {elapsed * 1000:8.1f} ms, {len(api.requests) - requests} requests, "
+            f"{hass.executor_jobs - jobs} executor jobs, {threading.active_count() - threads:+d} threads, "
+            f"{len(api.connections)} TCP connections so far"
+        )
+
+
+async def main(count, delay):
+    logging.disable(logging.CRITICAL) # The outage rounds log an error per sensor
+    module = load_sensor()
+    payload = make_payload(150)
+    with tempfile.TemporaryDirectory() as config_dir:
+        async with FakeApi(payload, delay=delay) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(config_dir)
+            install_stubs(module, hass, session)
+            sensors = [
+                create_sensor(module, hass, stop_id=str(900000000 + index), direction_id="900003200", endpoints=[api.url])
+                for index in range(count)
+            ]
+            await run_rounds(module, hass, api, sensors, "online")
+            # Outage: every request fails, the sensors read their cache files in the executor
+            await hass.async_block_till_done()
+            api.status = 503
+            await run_rounds(module, hass, api, sensors, "outage")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50, float(sys.argv[2]) if len(sys.argv) > 2 else 0.1))
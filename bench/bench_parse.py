@@ -0,0 +1,76 @@
+"""
+Per departure cost of turning the API's departure times into comparable values: the former
+path (timezone lookup, fromisoformat, conversion to the local timezone, aware datetime
+comparison) against parse_when, without and with its memo.
+
+    python bench/bench_parse.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from helpers import load_fixture, load_sensor # noqa: E402
+
+try:
+    import pytz
+except ImportError: # No longer needed by the sensor
+    pytz = None
+
+REPEAT = 20
+
+
+def per_departure(function, whens):
+    """Fastest of REPEAT runs over all departure times, in microseconds per departure."""
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function(whens)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(whens) * 1e6
+
+
+def before(whens):
+    """The former parsing, repeated for each departure slot."""
+    current_timezone = pytz.timezone("Europe/Berlin")
+    date_now = datetime.now(current_timezone)
+    for when in whens:
+        dep_time = datetime.fromisoformat(when).astimezone(current_timezone)
+        if dep_time > date_now:
+            (dep_time - date_now).total_seconds() // 60
+
+
+def main():
+    module = load_sensor()
+    payload = load_fixture("hauptbahnhof_90min")
+    whens = [departure["when"] for departure in payload["departures"]]
+
+    def after_cold(whens):
+        module.parse_when.cache_clear()
+        now = time.time()
+        for when in whens:
+            (module.parse_when(when) - now) // 60
+
+    def after_memo(whens):
+        now = time.time()
+        for when in whens:
+            (module.parse_when(when) - now) // 60
+
+    def records(whens):
+        module.parse_when.cache_clear()
+        module.parse_departures(payload)
+
+    print(f"{len(whens)} departure times, microseconds per departure")
+    if pytz is not None:
+        print(f"{'before (pytz, aware datetimes)':<34} {per_departure(before, whens):8.2f}")
+    else:
+        print(f"{'before (pytz, aware datetimes)':<34} {'pytz not installed':>8}")
+    print(f"{'parse_when, not memoized':<34} {per_departure(after_cold, whens):8.2f}")
+    print(f"{'parse_when, memoized':<34} {per_departure(after_memo, whens):8.2f}")
+    print(f"{'parse_departures, whole record':<34} {per_departure(records, whens):8.2f}")
+
+
+if __name__ == "__main__":
+    main()
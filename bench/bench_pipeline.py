@@ -0,0 +1,157 @@
+"""
+Benchmarks the update pipeline against the payloads of tests/fixtures, served by a stand-in API
+server on a local port with a stub hass. Reports the latency of each stage, the memory allocated
+by an update and how updates scale with the number of sensors.
+
+    python bench/bench_pipeline.py [fixture ...]
+"""
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_fixture, load_sensor # noqa: E402
+
+FIXTURE_NAMES = ["suburban_stop_15min", "hub_30min", "hauptbahnhof_90min"]
+REPEAT = 20
+SENSOR_COUNTS = [1, 10, 50]
+TRANSIT_TYPES = [None, "bus", "tram", "suburban", "regional"]
+
+
+def milliseconds(timings):
+    """Median of timings in seconds, as milliseconds."""
+    return statistics.median(timings) * 1000
+
+
+async def time_async(function, repeat=REPEAT):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_sync(function, repeat=REPEAT):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def refetch(sensors):
+    """Makes the next update request the API again and receive a full payload."""
+    for sensor in sensors:
+        sensor._next_refresh = None
+        sensor._fetcher._fetched_at = None
+        sensor._fetcher._data = None # No conditional request, the stand-in would answer 304
+
+
+async def bench_stages(module, hass, api, session, name, payload):
+    """Per stage latency and allocations of one sensor on a fixture."""
+    sensor = create_sensor(module, hass, stop_id=name, direction_id="900003200", walking_distance=5, endpoints=[api.url])
+    fetcher = sensor._fetcher
+
+    fetch, decode = [], []
+    for _ in range(REPEAT):
+        refetch([sensor])
+        await fetcher.fetch(session, 0)
+        fetch.append(fetcher.fetch_time)
+        decode.append(fetcher.parse_time)
+
+    async def update():
+        refetch([sensor])
+        await sensor.async_update()
+
+    updates = await time_async(update)
+    ticks = await time_async(sensor.async_update) # Between refreshes, no request
+    select = time_sync(lambda: sensor.getConnections(sensor.min_due_in, sensor._num_departures))
+    attributes = time_sync(sensor.buildAttributes)
+
+    await hass.async_block_till_done() # The cache file is written in the background
+    refetch([sensor])
+    sensor._fetcher._fetched_at = time.monotonic() + 3600 # Skip requests, read the cache file only
+
+    def cold_read():
+        module._OFFLINE_CACHE._entries.clear()
+        sensor._timetable_source = None
+        sensor.fetchDataFromFile()
+
+    def warm_read():
+        sensor._timetable_source = None
+        sensor.fetchDataFromFile()
+
+    cold, warm = time_sync(cold_read), time_sync(warm_read)
+
+    refetch([sensor])
+    tracemalloc.start()
+    await sensor.async_update()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:<22} {len(payload['departures']):>5} {fetcher.bytes_received / 1024:>8.1f} "
+        f"{milliseconds(fetch):>7.2f} {milliseconds(decode):>7.2f} {milliseconds(select):>7.3f} "
+        f"{milliseconds(attributes):>7.3f} {milliseconds(updates):>7.2f} {milliseconds(ticks):>7.3f} "
+        f"{milliseconds(cold):>7.2f} {milliseconds(warm):>7.3f} {peak / 1024:>8.0f} {current / 1024:>8.0f}"
+    )
+
+
+async def bench_scaling(module, hass, api, name, count):
+    """Update time of 'count' sensors, on one stop with different transit types and on as many stops."""
+    results = []
+    for stops in (1, count):
+        sensors = [
+            create_sensor(
+                module, hass, stop_id=f"{name}-{stops}-{index % stops}", transit_type=TRANSIT_TYPES[index % len(TRANSIT_TYPES)],
+                direction_id="900003200", walking_distance=5, endpoints=[api.url],
+            )
+            for index in range(count)
+        ]
+
+        async def update():
+            refetch(sensors)
+            await asyncio.gather(*(sensor.async_update() for sensor in sensors))
+
+        results.append(milliseconds(await time_async(update, repeat=5)))
+    print(f"{name:<22} {count:>7} {results[0]:>12.2f} {results[1]:>14.2f}")
+
+
+async def main(names):
+    logging.disable(logging.CRITICAL)
+    module = load_sensor()
+    payloads = {name: load_fixture(name) for name in names}
+    with tempfile.TemporaryDirectory() as config_dir:
+        async with FakeApi(lambda request: payloads[request.match_info["stop_id"].split("-")[0]]) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(config_dir)
+            install_stubs(module, hass, session)
+
+            print("Median milliseconds per stage, kilobytes allocated by an update")
+            print(
+                f"{'fixture':<22} {'deps':>5} {'KiB wire':>8} {'fetch':>7} {'decode':>7} {'select':>7} {'attrs':>7} "
+                f"{'update':>7} {'tick':>7} {'cold rd':>7} {'warm rd':>7} {'peak KiB':>8} {'kept KiB':>8}"
+            )
+            for name in names:
+                await bench_stages(module, hass, api, session, name, payloads[name])
+
+            print()
+            print("Median milliseconds to update all sensors")
+            print(f"{'fixture':<22} {'sensors':>7} {'one stop':>12} {'one stop each':>14}")
+            for name in names:
+                for count in SENSOR_COUNTS:
+                    await bench_scaling(module, hass, api, name, count)
+            await hass.async_block_till_done()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:] or FIXTURE_NAMES))
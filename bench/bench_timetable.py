@@ -0,0 +1,72 @@
+"""
+Scaling of the departure selection with the window size N and the number of departures k,
+against the former per-slot rescan that parsed and sorted the whole window once per slot.
+
+    python bench/bench_timetable.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from helpers import StubHass, create_sensor, load_sensor, make_payload # noqa: E402
+
+SIZES = (50, 200, 1000, 4000)
+COUNTS = (1, 4, 16)
+WALKING_DISTANCE = 5
+
+
+def best_of(function, repeat=5):
+    """Returns the fastest of 'repeat' runs in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def per_slot_rescan(payload, count):
+    """The selection before the timetable: every slot parsed, filtered and sorted the whole window again."""
+    now = datetime.now().astimezone()
+    selected = []
+    for slot in range(count):
+        timetable = []
+        for departure in payload["departures"]:
+            when = datetime.fromisoformat(departure["when"])
+            minutes = int((when - now).total_seconds() // 60)
+            if minutes >= WALKING_DISTANCE:
+                timetable.append((minutes, departure))
+        timetable.sort(key=lambda item: item[0])
+        if len(timetable) > slot:
+            selected.append(timetable[slot])
+    return selected
+
+
+async def main():
+    module = load_sensor()
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = StubHass(config_dir)
+        print(f"{'N':>6} {'k':>4} {'parse ms':>10} {'select ms':>10} {'rescan ms':>10}")
+        for size in SIZES:
+            payload = make_payload(size)
+            parse = best_of(lambda: module.parse_departures(payload))
+            for count in COUNTS:
+                sensor = create_sensor(
+                    module, hass, stop_id="900003201", direction_id="900003200",
+                    walking_distance=WALKING_DISTANCE, num_departures=count,
+                )
+                sensor.data = payload
+                sensor._cache_created_at = time.time()
+                sensor.buildTimetable(module.parse_departures(payload))
+                select = best_of(lambda: sensor.getConnections(WALKING_DISTANCE, count))
+                rescan = best_of(lambda: per_slot_rescan(payload, count), repeat=3)
+                print(f"{size:>6} {count:>4} {parse:>10.3f} {select:>10.3f} {rescan:>10.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""
+Replays a simulated day of departures payloads against sensors with different refresh settings
+and reports the API requests each one made, and in how many minutes its state differed from a
+sensor requesting every minute.
+
+    python bench/replay_refresh.py
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from helpers import BERLIN, StubHass, create_sensor, install_stubs, load_sensor, make_payload # noqa: E402
+
+DAY_START = datetime(2024, 5, 7, 0, 0, tzinfo=BERLIN)
+WINDOW = timedelta(minutes=90) # The API's duration
+# Departures per hour of the day, a busy tram and bus stop
+DEPARTURES_PER_HOUR = [4, 2, 2, 2, 4, 12, 30, 40, 40, 30, 24, 24, 24, 24, 30, 36, 40, 40, 30, 24, 16, 12, 8, 6]
+# (name, refresh_interval, max_refresh_interval)
+SETTINGS = [
+    ("fixed 60 s", 60, 60),
+    ("fixed 180 s", 180, 180),
+    ("adaptive 60-300 s", 60, 300),
+    ("adaptive 60-900 s", 60, 900),
+]
+
+
+class Clock:
+    """Simulated time.time and time.monotonic, advanced by the replay."""
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+def build_day():
+    """Returns the departures of a day in the API's format, sorted by planned time."""
+    departures = []
+    for hour, count in enumerate(DEPARTURES_PER_HOUR):
+        start = DAY_START + timedelta(hours=hour)
+        payload = make_payload(count, start=start, seed=hour, step=3600 // count)
+        departures.extend(payload["departures"])
+    return departures
+
+
+def replay_payload(departures, now, rng):
+    """The payload the API would answer at 'now': the next WINDOW of departures, with delays changing now and then."""
+    start, end = now, now + WINDOW
+    window = []
+    for departure in departures:
+        planned = datetime.fromisoformat(departure["plannedWhen"])
+        if start <= planned < end:
+            departure = dict(departure)
+            if rng.random() < 0.05: # A delay changed since the last request
+                delay = rng.choice([0, 60, 120, 240])
+                departure["delay"] = delay
+                departure["when"] = (planned + timedelta(seconds=delay)).isoformat()
+            window.append(departure)
+    return {"departures": window}
+
+
+async def main():
+    logging.disable(logging.CRITICAL)
+    module = load_sensor()
+    clock = Clock(DAY_START.timestamp())
+    module.time = types.SimpleNamespace(time=clock.time, monotonic=clock.monotonic, perf_counter=time.perf_counter)
+    departures = build_day()
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = StubHass(config_dir)
+        install_stubs(module, hass, None) # Requests are replayed, no session needed
+        sensors = []
+        for index, (name, refresh_interval, max_refresh_interval) in enumerate(SETTINGS):
+            sensor = create_sensor(
+                module, hass, name=name, stop_id=str(index), direction_id="900003200", walking_distance=5,
+                refresh_interval=refresh_interval, max_refresh_interval=max_refresh_interval,
+            )
+            sensor._cache_writer.schedule = lambda data, timetable: None
+            sensors.append(sensor)
+
+        requests = [0] * len(sensors)
+        current = {} # The payload of the current minute, every sensor requesting in it sees the same one
+
+        def replay_fetch(index):
+            async def fetch(session, max_age):
+                requests[index] += 1
+                return current["data"], current["timetable"]
+            return fetch
+
+        for index, sensor in enumerate(sensors):
+            sensor._fetcher.fetch = replay_fetch(index)
+
+        mismatches = [0] * len(sensors)
+        for minute in range(24 * 60):
+            clock.now = DAY_START.timestamp() + minute * 60
+            data = replay_payload(departures, datetime.fromtimestamp(clock.now, BERLIN), rng)
+            current["data"], current["timetable"] = data, module.parse_departures(data)
+            for sensor in sensors:
+                await sensor.async_update()
+            reference = (sensors[0].state, [departure[1] and departure[1].trip_id for departure in sensors[0].departures])
+            for index, sensor in enumerate(sensors):
+                if (sensor.state, [departure[1] and departure[1].trip_id for departure in sensor.departures]) != reference:
+                    mismatches[index] += 1
+
+        print(f"{'setting':<20} {'requests':>9} {'saved':>7} {'minutes differing':>18}")
+        for (name, _, _), count, mismatch in zip(SETTINGS, requests, mismatches):
+            saved = 1 - count / requests[0]
+            print(f"{name:<20} {count:>9} {saved:>7.0%} {mismatch:>18}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
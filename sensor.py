@@ -11,20 +11,59 @@
 # Version 0.4.2 added retrieval of next train/bus and corresponding _next attributes
 # Version 0.4.3 updated BVG api to v6
 # Version 0.5.0 Refactored to store multiple departures in a list, removed _NEXT attributes, fetches up to 4 departures by default.
+# Version 0.5.1 parse departures once per fetch and select the next departures in a single pass
+# Version 0.5.2 sensors on the same stop and direction share one API request, transit type is filtered locally
+# Version 0.6.0 switched to async_update with Home Assistant's shared aiohttp session, cache file I/O runs in the executor
+# Version 0.6.1 conditional requests with ETag/If-Modified-Since and gzip, unchanged departures are not parsed again
+# Version 0.6.2 cache file is written atomically in the background, at most once per cache_flush_interval and only if changed
+# Version 0.6.3 offline mode keeps the parsed cache file in memory and only reloads it if the file changed
+# Version 0.6.4 departures are stored as compact records with epoch timestamps, ISO strings are rendered on read
+# Version 0.6.5 refresh_interval added, due_in is recomputed locally every minute between API requests
+# Version 0.6.6 max_refresh_interval added, the refresh interval adapts to the next departure and changing delays
+# Version 0.6.7 circuit breaker per API host, requests pause with exponential backoff while the API is down, breaker_status attribute added
+# Version 0.6.8 attributes are built once per update and unchanged states aren't written again, num_departures and slim_departures added
+# Version 0.6.9 batch mode: a list of stops in one platform config is updated in a single scheduled batch
+# Version 0.6.10 diagnostics option added, exposes timings and counters of the update stages
+# Version 0.6.11 timezone resolved once per sensor, departure times parsed straight to epoch seconds and memoized, cache age in epoch seconds
+# Version 0.6.12 departures are parsed incrementally from the cache file, streaming option parses responses while they are received and stops once the next departures are certain
+# Version 0.6.13 cache_format option added, the binary cache format stores only the departure records and is loaded via mmap, JSON caches stay readable
+# Version 0.6.14 sensors show the cached departures right after setup, the first request is deferred and staggered, pytz replaced by Home Assistant's timezones
+# Version 0.6.15 direction_id is optional to fetch all directions of a stop at once, views added to select departures by destination, transit type and line from a local index
+# Version 0.6.16 endpoints option added, requests go to the fastest healthy endpoint and are hedged on a second one after its p95 latency
 
-from urllib.request import urlopen
-from urllib.error import URLError, HTTPError # Added HTTPError for explicit import
+import asyncio
+import bisect
+import codecs
+import hashlib
+import heapq
 import json
-import pytz
+import mmap
 
 import os.path
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
 
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from functools import lru_cache
+from operator import attrgetter
+from urllib.parse import urlsplit
+
+from datetime import datetime, timedelta, timezone
 
 import logging
+import aiohttp
 import voluptuous as vol
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_call_later, async_track_time_interval
 import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 
 _LOGGER = logging.getLogger(__name__)
@@ -41,6 +80,9 @@ ATTR_TRANS_TYPE = "type"
 ATTR_TRIP_ID = "trip" # This key is used in the departure objects, not usually a top-level attribute
 ATTR_LINE_NAME = "line_name"
 ATTR_CONNECTION_STATE = "connection_status"
+ATTR_BREAKER_STATE = "breaker_status"
+ATTR_DIAGNOSTICS = "diagnostics"
+ATTR_VIEWS = "views"
 
 # Attribute to hold a list of all fetched departure details
 ATTR_DEPARTURES = "departures"
@@ -52,11 +94,32 @@ CONF_TRANS_TYPE_RESTRICTION = "transit_type"
 CONF_MIN_DUE_IN = "walking_distance"
 CONF_CACHE_PATH = "file_path"
 CONF_CACHE_SIZE = "cache_size"
+CONF_CACHE_FLUSH_INTERVAL = "cache_flush_interval"
+CONF_REFRESH_INTERVAL = "refresh_interval"
+CONF_MAX_REFRESH_INTERVAL = "max_refresh_interval"
+CONF_NUM_DEPARTURES = "num_departures"
+CONF_SLIM_DEPARTURES = "slim_departures"
+CONF_STOPS = "stops"
+CONF_DIAGNOSTICS = "diagnostics"
+CONF_STREAMING = "streaming"
+CONF_CACHE_FORMAT = "cache_format"
+CONF_VIEWS = "views"
+CONF_DIRECTIONS = "directions"
+CONF_LINES = "lines"
+CONF_ENDPOINTS = "endpoints"
 
 CONNECTION_STATE = "connection_state" # Internal key for self._con_state
 CON_STATE_ONLINE = "online"
 CON_STATE_OFFLINE = "offline"
 
+CACHE_FORMAT_JSON = "json"
+CACHE_FORMAT_BINARY = "binary"
+CACHE_FORMATS = [CACHE_FORMAT_JSON, CACHE_FORMAT_BINARY]
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
 ICONS = {
     "suburban": "mdi:subway-variant",
     "subway": "mdi:subway",
@@ -80,71 +143,1073 @@ TRANSIT_TYPES = [
 ]
 
 SCAN_INTERVAL = timedelta(seconds=60)
-NUM_DEPARTURES_TO_FETCH = 4 # Configure how many departures to fetch
+SHARED_FETCH_MAX_AGE = timedelta(seconds=30) # Sensors polling the same request within this window share one response
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=5)
+DEFAULT_ENDPOINT = "https://v6.bvg.transport.rest"
+LATENCY_SAMPLES = 50 # Latencies kept per endpoint to rank endpoints and pick the hedging delay
+HEDGE_MIN_SAMPLES = 5 # Latencies needed before the p95 is used as hedging delay
+HEDGE_DEFAULT_DELAY = 1.0 # Seconds before a second endpoint is requested while the latency is unknown
+HEDGE_MIN_DELAY = 0.05
+PARALLEL_UPDATES = 0 # Sensors update concurrently, they only wait on the network
+DEFAULT_CACHE_FLUSH_INTERVAL = 300 # Seconds between cache file writes
+MAX_OFFLINE_CACHE_ENTRIES = 32 # Cache files kept parsed in memory
+WHEN_CACHE_SIZE = 4096 # Parsed departure time strings kept in memory, shared by all sensors
+BERLIN_TIMEZONE = "Europe/Berlin" # Assumed for departure times without offset
+DEFAULT_REFRESH_INTERVAL = 60 # Seconds between API requests, due_in is recomputed every SCAN_INTERVAL
+REFRESH_SLACK = 5 # Seconds a refresh may be brought forward to not miss it by a poll's jitter
+BREAKER_FAILURE_THRESHOLD = 3 # Consecutive failures before requests to an API host are stopped
+BREAKER_MIN_BACKOFF = 30 # Seconds until the first probe request, doubled for every failed probe
+BREAKER_MAX_BACKOFF = 900
+BATCH_MAX_CONCURRENCY = 4 # Sensors updated at the same time in batch mode
+STARTUP_DELAY = 5 # Seconds after setup until the first request, the cached departures are shown meanwhile
+STARTUP_STAGGER = 10 # Seconds the first requests of polled sensors are spread over
+ADAPTIVE_NEAR_THRESHOLD = 3 # Minutes before the next departure drops below walking_distance, refreshed at the shortest interval
+NUM_DEPARTURES_TO_FETCH = 4 # Default for how many departures to fetch
+STREAM_CHUNK_SIZE = 16384 # Bytes of a response or cache file parsed at once
+# Binary cache layout: header, string lengths, UTF-8 strings, then one fixed size record per departure
+BINARY_CACHE_MAGIC = b"BVGD"
+BINARY_CACHE_VERSION = 1
+BINARY_CACHE_HEADER = struct.Struct("<4sHII") # Magic, version, number of departures, number of strings
+BINARY_CACHE_RECORD = struct.Struct("<qhIIIII") # when, delay, then string indices of trip, line, product, direction, stop
+BINARY_CACHE_NONE = 0xFFFFFFFF # String index of a missing value
+STREAM_EARLY_MARGIN = 300 # Seconds a departure may leave before its planned time, streaming stops only past this margin
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
+# A stop of the batch mode, unset options are taken from the platform config
+STOP_SCHEMA = vol.Schema(
     {
         vol.Required(CONF_STOP_ID): cv.string,
-        vol.Required(CONF_DIRECTION_ID): cv.string,
+        vol.Optional(CONF_DIRECTION_ID): cv.string,
         vol.Optional(CONF_TRANS_TYPE_RESTRICTION): cv.string,
-        vol.Optional(CONF_MIN_DUE_IN, default=10): cv.positive_int,
-        vol.Optional(CONF_CACHE_PATH, default="/"): cv.string,
-        vol.Optional(CONF_NAME, default="BVG"): cv.string,
-        vol.Optional(CONF_CACHE_SIZE, default=90): cv.positive_int,
+        vol.Optional(CONF_MIN_DUE_IN): cv.positive_int,
+        vol.Optional(CONF_NAME): cv.string,
     }
 )
 
+# A named selection of a sensor's departures, a departure has to match one value of every given filter
+VIEW_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_NAME): cv.string,
+        vol.Optional(CONF_DIRECTIONS): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_TRANS_TYPE_RESTRICTION): vol.All(cv.ensure_list, [vol.In(TRANSIT_TYPES)]),
+        vol.Optional(CONF_LINES): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_NUM_DEPARTURES): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    }
+)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
-    """Setup the sensor platform."""
-    stop_id = config[CONF_STOP_ID]
-    direction_id = config.get(CONF_DIRECTION_ID)
-    transit_type = config.get(CONF_TRANS_TYPE_RESTRICTION)
-    min_due_in = config.get(CONF_MIN_DUE_IN)
-    file_path = config.get(CONF_CACHE_PATH)
-    name = config.get(CONF_NAME)
-    cache_size = config.get(CONF_CACHE_SIZE)
-    add_entities(
-        [BvgSensor(name, stop_id, direction_id, transit_type, min_due_in, file_path, hass, cache_size)]
+PLATFORM_SCHEMA = vol.All(
+    cv.has_at_least_one_key(CONF_STOP_ID, CONF_STOPS),
+    PLATFORM_SCHEMA.extend(
+        {
+            vol.Optional(CONF_STOP_ID): cv.string,
+            vol.Optional(CONF_DIRECTION_ID): cv.string, # Without a direction all departures of the stop are fetched
+            vol.Optional(CONF_TRANS_TYPE_RESTRICTION): cv.string,
+            vol.Optional(CONF_MIN_DUE_IN, default=10): cv.positive_int,
+            vol.Optional(CONF_CACHE_PATH, default="/"): cv.string,
+            vol.Optional(CONF_NAME, default="BVG"): cv.string,
+            vol.Optional(CONF_CACHE_SIZE, default=90): cv.positive_int,
+            vol.Optional(CONF_CACHE_FLUSH_INTERVAL, default=DEFAULT_CACHE_FLUSH_INTERVAL): cv.positive_int,
+            vol.Optional(CONF_REFRESH_INTERVAL, default=DEFAULT_REFRESH_INTERVAL): cv.positive_int,
+            vol.Optional(CONF_MAX_REFRESH_INTERVAL): cv.positive_int,
+            vol.Optional(CONF_NUM_DEPARTURES, default=NUM_DEPARTURES_TO_FETCH): vol.All(vol.Coerce(int), vol.Range(min=1)),
+            vol.Optional(CONF_SLIM_DEPARTURES, default=False): cv.boolean,
+            vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+            vol.Optional(CONF_STREAMING, default=False): cv.boolean,
+            vol.Optional(CONF_CACHE_FORMAT, default=CACHE_FORMAT_JSON): vol.In(CACHE_FORMATS),
+            vol.Optional(CONF_STOPS): vol.All(cv.ensure_list, [STOP_SCHEMA]),
+            vol.Optional(CONF_VIEWS): vol.All(cv.ensure_list, [VIEW_SCHEMA]),
+            vol.Optional(CONF_ENDPOINTS, default=[DEFAULT_ENDPOINT]): vol.All(cv.ensure_list, [cv.url]),
+        }
+    ),
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of requesting an API host while its circuit breaker is open."""
+
+
+def is_host_failure(error):
+    """Returns whether an error means the API host is unavailable, as opposed to a bad request."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an API host after repeated failures, so sensors use their cached
+    data without waiting for timeouts. After a jittered exponential backoff a single probe
+    request is let through (half open), its result closes or reopens the breaker.
+    """
+
+    def __init__(self):
+        """Initialize the breaker."""
+        self.state = BREAKER_CLOSED
+        self._failures = 0 # Consecutive failures
+        self._backoff = BREAKER_MIN_BACKOFF
+        self._retry_at = None # time.monotonic() when the next probe is allowed
+
+    def allow_request(self):
+        """Returns whether a request may be sent, letting through a single probe while open."""
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN and time.monotonic() >= self._retry_at:
+            self.state = BREAKER_HALF_OPEN # This request is the probe
+            return True
+        return False
+
+    def record_success(self):
+        """Closes the breaker after a successful request."""
+        if self.state != BREAKER_CLOSED:
+            _LOGGER.warning("BVG API is reachable again, resuming requests.")
+        self.state = BREAKER_CLOSED
+        self._failures = 0
+        self._backoff = BREAKER_MIN_BACKOFF
+
+    def record_failure(self):
+        """Opens the breaker after too many failures or a failed probe."""
+        self._failures += 1
+        if self.state == BREAKER_HALF_OPEN:
+            self._backoff = min(self._backoff * 2, BREAKER_MAX_BACKOFF)
+        elif self._failures < BREAKER_FAILURE_THRESHOLD:
+            return
+        delay = self._backoff * random.uniform(0.5, 1) # Jitter, so stops don't probe in lockstep
+        if self.state == BREAKER_CLOSED:
+            _LOGGER.warning(f"BVG API failed {self._failures} times, pausing requests for {delay:.0f} seconds and using local cache.")
+        self.state = BREAKER_OPEN
+        self._retry_at = time.monotonic() + delay
+
+    def cancel_probe(self):
+        """Reopens the breaker after its probe was cancelled, the next request probes again with the same backoff."""
+        self.state = BREAKER_OPEN
+        self._retry_at = time.monotonic()
+
+
+# Shared circuit breakers, keyed by API host
+_BREAKERS = {}
+
+
+def get_breaker(url):
+    """Returns the shared circuit breaker for the host of an URL."""
+    return _BREAKERS.setdefault(urlsplit(url).netloc, CircuitBreaker())
+
+
+# Shared endpoints, keyed by base URL
+_ENDPOINTS = {}
+
+
+def get_endpoint(base_url):
+    """Returns the shared endpoint for a base URL."""
+    base_url = base_url.rstrip("/")
+    return _ENDPOINTS.setdefault(base_url, Endpoint(base_url))
+
+
+class Endpoint:
+    """An instance of the departures API with its circuit breaker and the latencies of its last requests."""
+
+    def __init__(self, base_url):
+        """Initialize the endpoint."""
+        self.base_url = base_url
+        self.breaker = get_breaker(base_url)
+        self._latencies = deque(maxlen=LATENCY_SAMPLES) # Seconds of the last successful requests
+        self.failed = False # Whether the last request failed, e.g. a wrong base path answering 404
+
+    def url(self, path):
+        """Returns the URL of a path on this endpoint."""
+        return self.base_url + path
+
+    def record_latency(self, seconds):
+        """Records the duration of a successful request."""
+        self._latencies.append(seconds)
+
+    def latency(self):
+        """Returns the median latency, 0 if unknown so every endpoint is tried once."""
+        if not self._latencies:
+            return 0
+        return sorted(self._latencies)[len(self._latencies) // 2]
+
+    def hedge_delay(self):
+        """Returns the seconds to wait for this endpoint before hedging, its p95 latency once known."""
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return max(p95, HEDGE_MIN_DELAY)
+
+
+def wire_size(response, decoded_size):
+    """
+    Returns the bytes of a response body as received, before aiohttp decompressed it. Falls back
+    to the decoded size for responses without Content-Length, e.g. chunked ones.
+    """
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return decoded_size
+
+
+class DepartureFetcher:
+    """Fetches the departures of a stop once per interval for all sensors subscribed to it."""
+
+    def __init__(self, path, endpoints, streaming=False):
+        """Initialize the fetcher for a path of the API, available on a list of endpoints."""
+        self.path = path
+        self.endpoints = endpoints
+        self.streaming = streaming # Parse the response while it's received and stop once the subscribers are served
+        self._lock = asyncio.Lock() # Concurrent sensors wait for the request in flight
+        self._data = None
+        self._timetable = None # Departure records parsed from self._data
+        self._error = None
+        self._fetched_at = None # time.monotonic() of the last request
+        self._etag = None # Validators of the last response for conditional requests
+        self._last_modified = None
+        self._requirements = [] # (view, earliest) needed by each subscribed sensor, see EarlyStop
+        # Diagnostics of the last request
+        self.endpoint = None # Base URL of the endpoint that answered
+        self.fetch_time = None # Seconds until the response was received
+        self.bytes_received = 0
+        self.parse_time = None # Seconds spent decoding and parsing the response
+
+    @property
+    def url(self):
+        """The URL on the first configured endpoint."""
+        return self.endpoints[0].url(self.path)
+
+    @property
+    def breaker_state(self):
+        """The state of the best circuit breaker of the endpoints."""
+        states = {endpoint.breaker.state for endpoint in self.endpoints}
+        for state in (BREAKER_CLOSED, BREAKER_HALF_OPEN):
+            if state in states:
+                return state
+        return BREAKER_OPEN
+
+    def subscribe(self, view, earliest):
+        """
+        Registers the departures a sensor needs: the first 'view.count' departures matching the
+        DepartureView, leaving at least 'earliest' seconds after the request. Streaming stops only
+        once all are certain.
+        """
+        self._requirements.append((view, earliest))
+
+    async def fetch(self, session, max_age):
+        """
+        Returns the departures JSON and its parsed timetable, requesting it from the BVG API only if the
+        last response is older than max_age seconds. A failed request is shared as well,
+        so the other sensors don't retry it within the same interval.
+        The request is conditional, an unchanged payload returns the same object as before.
+        Raises CircuitOpenError without a request while the breakers of all endpoints are open.
+        """
+        async with self._lock:
+            if self._fetched_at is None or time.monotonic() - self._fetched_at >= max_age:
+                # Fastest endpoints first, endpoints whose last request failed after them, endpoints with an open breaker last
+                endpoints = sorted(
+                    self.endpoints, key=lambda endpoint: (endpoint.breaker.state != BREAKER_CLOSED, endpoint.failed, endpoint.latency())
+                )
+                primary = next((endpoint for endpoint in endpoints if endpoint.breaker.allow_request()), None)
+                if primary is None:
+                    self.endpoint, self.fetch_time, self.bytes_received, self.parse_time = None, None, 0, None # No request
+                    hosts = ", ".join(urlsplit(endpoint.base_url).netloc for endpoint in self.endpoints)
+                    raise CircuitOpenError(f"Requests to {hosts} are paused")
+                self._fetched_at = time.monotonic()
+                headers = {"Accept-Encoding": "gzip"}
+                if self._data is not None:
+                    # Only ask for a new payload if the departures changed since the last response
+                    if self._etag is not None:
+                        headers["If-None-Match"] = self._etag
+                    if self._last_modified is not None:
+                        headers["If-Modified-Since"] = self._last_modified
+                start = time.perf_counter()
+                try:
+                    endpoint, result = await self._hedged_request(session, primary, endpoints, headers)
+                    self.endpoint = endpoint.base_url
+                    data, timetable, etag, last_modified, self.bytes_received, self.fetch_time, parse_time = result
+                    if data is None:
+                        # Not modified, keep the parsed payload so sensors neither re-parse nor rewrite the cache
+                        _LOGGER.debug(f"Departures not modified: {endpoint.url(self.path)}")
+                        self.parse_time = None # Nothing was parsed
+                    else:
+                        self._data, self._timetable, self.parse_time = data, timetable, parse_time
+                        self._etag, self._last_modified = etag, last_modified
+                    self._error = None
+                except asyncio.CancelledError:
+                    self._fetched_at = None
+                    raise
+                except Exception as e:
+                    # No endpoint answered, the time went into the failed requests
+                    self.endpoint, self.fetch_time, self.bytes_received, self.parse_time = None, time.perf_counter() - start, 0, None
+                    self._error = e
+            if self._error is not None:
+                raise self._error
+            return self._data, self._timetable
+
+    async def _hedged_request(self, session, primary, endpoints, headers):
+        """
+        Requests the primary endpoint. If it hasn't answered within its p95 latency, the next
+        healthy endpoint is requested as well and the first response wins. A failed endpoint
+        is failed over to the next one. Returns (endpoint, result) of the first successful request.
+        """
+        backups = iter([endpoint for endpoint in endpoints if endpoint is not primary])
+        pending = {asyncio.ensure_future(self._request(session, primary, headers))}
+        timeout = primary.hedge_delay()
+        error = None
+
+        def request_next():
+            for endpoint in backups:
+                if endpoint.breaker.allow_request():
+                    _LOGGER.debug(f"Requesting {endpoint.base_url} as well: {self.path}")
+                    pending.add(asyncio.ensure_future(self._request(session, endpoint, headers)))
+                    return
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not done:
+                    timeout = None # Hedge a slow request only once
+                    request_next()
+                elif not pending:
+                    request_next()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel() # The slower request lost
+            if pending:
+                await asyncio.wait(pending)
+
+    async def _request(self, session, endpoint, headers):
+        """
+        Requests the departures from one endpoint and records the result on its breaker.
+        Returns (endpoint, (data, timetable, etag, last_modified, bytes received, fetch seconds,
+        parse seconds)), data is None if the departures weren't modified.
+        """
+        url = endpoint.url(self.path)
+        start = time.perf_counter()
+        try:
+            _LOGGER.debug(f"Attempting to open URL: {url}")
+            async with session.get(url, headers=headers, timeout=FETCH_TIMEOUT, raise_for_status=True) as response:
+                if response.status == 304:
+                    result = (None, None, None, None, 0, time.perf_counter() - start, None)
+                elif self.streaming:
+                    data, timetable, received, parse_time, complete = await self._read_streaming(response, url)
+                    fetch_time = time.perf_counter() - start - parse_time
+                    # A window cut off at this request's time must not be kept by a later "not modified"
+                    validators = (response.headers.get("ETag"), response.headers.get("Last-Modified")) if complete else (None, None)
+                    result = (data, timetable, *validators, wire_size(response, received), fetch_time, parse_time)
+                else:
+                    body = await response.read()
+                    received = time.perf_counter()
+                    data = json.loads(body)
+                    timetable = parse_departures(data)
+                    result = (
+                        data, timetable, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                        wire_size(response, len(body)), received - start, time.perf_counter() - received,
+                    )
+        except asyncio.CancelledError:
+            # Lost against a faster endpoint. The time waited so far is only a lower bound of its latency,
+            # recording a shorter one would pull down the median of a slow endpoint.
+            elapsed = time.perf_counter() - start
+            if elapsed > endpoint.latency():
+                endpoint.record_latency(elapsed)
+            if endpoint.breaker.state == BREAKER_HALF_OPEN:
+                endpoint.breaker.cancel_probe() # Don't leave the breaker waiting for a cancelled probe
+            raise
+        except Exception as e:
+            endpoint.failed = True
+            if is_host_failure(e):
+                endpoint.breaker.record_failure()
+            else:
+                endpoint.breaker.record_success() # The host answered, the request itself is wrong
+            raise
+        endpoint.failed = False
+        endpoint.breaker.record_success()
+        endpoint.record_latency(result[5])
+        return endpoint, result
+
+    async def _read_streaming(self, response, url):
+        """
+        Parses the departures of a response while it's received and returns the payload, reduced
+        to the fields the sensors use, its timetable, the bytes received, the seconds spent parsing
+        and whether the whole payload was parsed. Parsing stops once the departures the subscribed
+        sensors need can't change anymore, the rest of the body is only drained.
+        """
+        parser = DepartureStreamParser()
+        early_stop = EarlyStop(self._requirements, time.time())
+        timetable = []
+        received = 0
+        parse_time = 0
+        stopped = False
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            received += len(chunk)
+            if stopped:
+                continue # Keep the pooled connection reusable
+            parse_start = time.perf_counter()
+            for pos in parser.feed(chunk):
+                departure = parse_departure(pos)
+                if departure is not None:
+                    timetable.append(departure)
+                if early_stop.reached(pos, departure):
+                    _LOGGER.debug(f"Stopped parsing after {len(timetable)} departures: {url}")
+                    stopped = True
+                    break
+            parse_time += time.perf_counter() - parse_start
+        if not stopped:
+            parser.close()
+        return {"departures": [departure.as_dict() for departure in timetable]}, timetable, received, parse_time, not stopped
+
+
+class Departure:
+    """A parsed departure with the departure time as epoch seconds and interned strings."""
+
+    __slots__ = ("when", "delay", "trip_id", "line_name", "product", "direction", "stop_name")
+
+    def __init__(self, when, delay, trip_id, line_name, product, direction, stop_name):
+        """Initialize the departure."""
+        self.when = when # Epoch seconds
+        self.delay = delay # Minutes
+        self.trip_id = trip_id
+        self.line_name = line_name
+        self.product = product
+        self.direction = direction
+        self.stop_name = stop_name
+
+    def as_dict(self):
+        """Returns the departure in the API's format, reduced to the fields the sensor uses."""
+        return {
+            "tripId": self.trip_id,
+            "when": datetime.fromtimestamp(self.when, timezone.utc).isoformat(),
+            "delay": self.delay * 60,
+            "direction": self.direction,
+            "line": {"name": self.line_name, "product": self.product},
+            "stop": {"name": self.stop_name},
+        }
+
+
+def _intern(value):
+    """Interns strings repeated across departures, like line and stop names."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@lru_cache(maxsize=WHEN_CACHE_SIZE)
+def parse_when(when):
+    """
+    Converts a departure time string to epoch seconds. Successive responses and sensors on the
+    same stop repeat most departure times, so results are memoized. Raises ValueError.
+    """
+    # Try to parse with timezone, then without if it fails (older formats might exist)
+    try:
+        # The API's format, e.g. "2023-05-01T10:00:00+02:00", has a fixed offset and is converted
+        # to epoch seconds without timezone lookups
+        dep_time = datetime.fromisoformat(when)
+    except ValueError: # Handle cases like "2024-05-07T10:00:00" (naive)
+        dep_time_naive = datetime.strptime(when.split('+')[0].split('Z')[0], "%Y-%m-%dT%H:%M:%S")
+        # Assume Berlin timezone for naive times from BVG API
+        dep_time = dep_time_naive.replace(tzinfo=dt_util.get_time_zone(BERLIN_TIMEZONE))
+
+    # Ensure dep_time is timezone-aware before converting it to epoch seconds
+    if dep_time.tzinfo is None or dep_time.tzinfo.utcoffset(dep_time) is None:
+        _LOGGER.warning(f"Departure time {when} is naive. Assuming Europe/Berlin.")
+        dep_time = dep_time.replace(tzinfo=dt_util.get_time_zone(BERLIN_TIMEZONE))
+    return int(dep_time.timestamp())
+
+
+def parse_departure(pos):
+    """Parses a departure object of an API response into a Departure record, or None if it has no valid time."""
+    if pos.get("when") is None: # Departure time is missing
+        _LOGGER.debug(f"Skipping entry due to missing 'when' field: {pos.get('tripId', 'Unknown Trip')}")
+        return None
+
+    try:
+        when = parse_when(pos["when"])
+    except ValueError as e:
+        _LOGGER.error(f"Could not parse departure time string: {pos['when']}. Error: {e}. Skipping entry.")
+        return None
+
+    line = pos.get("line") or {}
+    return Departure(
+        when,
+        (pos.get("delay", 0) // 60) if pos.get("delay") is not None else 0, # Delay in minutes
+        pos.get("tripId"),
+        _intern(line.get("name")),
+        _intern(line.get("product")),
+        _intern(pos.get("direction")),
+        _intern((pos.get("stop") or {}).get("name")),
     )
 
 
+def parse_departures(data):
+    """Parses the departures of an API response into a list of Departure records."""
+    return [departure for departure in map(parse_departure, data["departures"]) if departure is not None]
+
+
+class DepartureStreamParser:
+    """
+    Incremental parser for the "departures" array of an API response or cache file. Each
+    departure object is decoded as soon as its bytes arrived, the document is never decoded as a whole.
+    """
+
+    KEY = '"departures"'
+
+    def __init__(self):
+        """Initialize the parser."""
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")() # Chunks may split multi-byte characters
+        self._buffer = ""
+        self._in_array = False
+        self.done = False # The closing bracket of the array was parsed
+
+    def feed(self, chunk):
+        """Parses the next bytes and returns the departure objects completed by them."""
+        buffer = self._buffer + self._text.decode(chunk)
+        pos = 0
+        if not self._in_array:
+            key = buffer.find(self.KEY)
+            bracket = buffer.find("[", key) if key != -1 else -1
+            if bracket == -1:
+                # Keep what could be the start of the key or the text up to the bracket
+                self._buffer = buffer[key:] if key != -1 else buffer[-len(self.KEY):]
+                return []
+            self._in_array = True
+            pos = bracket + 1
+
+        departures = []
+        end = len(buffer)
+        while not self.done:
+            while pos < end and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == end:
+                break
+            if buffer[pos] == "]":
+                self.done = True
+                break
+            try:
+                pos_object, next_pos = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break # Incomplete object, wait for the next chunk
+            departures.append(pos_object)
+            pos = next_pos
+        self._buffer = buffer[pos:] if not self.done else ""
+        return departures
+
+    def close(self):
+        """Raises json.JSONDecodeError if the departures array wasn't complete."""
+        if not self.done:
+            raise json.JSONDecodeError("Incomplete departures array", self._buffer, 0)
+
+
+class EarlyStop:
+    """
+    Decides when a departures array can't change the next departures of the subscribed sensors
+    anymore. The API lists departures by planned time, so once the planned time passes the
+    last needed departure (less STREAM_EARLY_MARGIN for early trains), the rest is irrelevant.
+    Falls back to parsing everything as soon as the order is broken.
+    """
+
+    def __init__(self, requirements, now):
+        """Initialize the check for the requirements of a fetcher's subscribers."""
+        # Per requirement the latest times of the 'count' earliest matching departures, as max-heap
+        self._requirements = [(view, now + earliest, []) for view, earliest in requirements]
+        self._last_planned = None
+        self.enabled = bool(requirements)
+
+    def reached(self, pos, departure):
+        """Checks the next parsed departure object and its record (None if skipped)."""
+        if not self.enabled:
+            return False
+        try:
+            planned = parse_when(pos.get("plannedWhen") or pos["when"])
+        except (KeyError, TypeError, ValueError):
+            return False # No time to judge the order by, e.g. cancelled without planned time
+        if self._last_planned is not None and planned < self._last_planned:
+            _LOGGER.debug("Departures aren't sorted by planned time, parsing all of them")
+            self.enabled = False
+            return False
+        self._last_planned = planned
+
+        done = True
+        for view, earliest, latest in self._requirements:
+            if departure is not None and departure.when >= earliest and view.matches(departure):
+                heapq.heappush(latest, -departure.when)
+                if len(latest) > view.count:
+                    heapq.heappop(latest) # Drop the latest, it's not among the 'count' earliest anymore
+            if len(latest) < view.count or planned - STREAM_EARLY_MARGIN < -latest[0]:
+                done = False
+        return done
+
+
+def encode_departures(timetable):
+    """Encodes Departure records in the binary cache format."""
+    strings = {} # String -> index, repeated names are stored once
+    def index(value):
+        if value is None:
+            return BINARY_CACHE_NONE
+        return strings.setdefault(value, len(strings))
+
+    records = b"".join(
+        BINARY_CACHE_RECORD.pack(
+            departure.when, departure.delay, index(departure.trip_id), index(departure.line_name),
+            index(departure.product), index(departure.direction), index(departure.stop_name),
+        )
+        for departure in timetable
+    )
+    encoded = [string.encode("utf-8") for string in strings]
+    return b"".join((
+        BINARY_CACHE_HEADER.pack(BINARY_CACHE_MAGIC, BINARY_CACHE_VERSION, len(timetable), len(encoded)),
+        struct.pack(f"<{len(encoded)}I", *map(len, encoded)),
+        *encoded,
+        records,
+    ))
+
+
+def decode_departures(buffer):
+    """
+    Decodes Departure records from a buffer in the binary cache format, e.g. a memoryview of
+    a mapped file. Only the strings are copied. Raises ValueError if the buffer isn't supported.
+    """
+    if len(buffer) < BINARY_CACHE_HEADER.size:
+        raise ValueError("Truncated binary cache header")
+    magic, version, count, string_count = BINARY_CACHE_HEADER.unpack_from(buffer)
+    if magic != BINARY_CACHE_MAGIC or version != BINARY_CACHE_VERSION:
+        raise ValueError(f"Unsupported binary cache version {version}")
+    offset = BINARY_CACHE_HEADER.size
+    if len(buffer) < offset + 4 * string_count:
+        raise ValueError("Truncated binary cache string table")
+    lengths = struct.unpack_from(f"<{string_count}I", buffer, offset)
+    offset += 4 * string_count
+    if len(buffer) < offset + sum(lengths):
+        raise ValueError("Truncated binary cache strings")
+    strings = []
+    for length in lengths:
+        strings.append(sys.intern(str(buffer[offset:offset + length], "utf-8")))
+        offset += length
+    if len(buffer) != offset + count * BINARY_CACHE_RECORD.size:
+        raise ValueError("Truncated binary cache records")
+
+    def string(index):
+        return strings[index] if index != BINARY_CACHE_NONE else None
+
+    return [
+        Departure(when, delay, string(trip_id), string(line_name), string(product), string(direction), string(stop_name))
+        for when, delay, trip_id, line_name, product, direction, stop_name
+        in BINARY_CACHE_RECORD.iter_unpack(buffer[offset:])
+    ]
+
+
+def _fold(value):
+    """Normalizes names for case-insensitive matching."""
+    return value.casefold() if isinstance(value, str) else value
+
+
+class DepartureView:
+    """A named selection of departures by destination, transit type and line. Unset filters match everything."""
+
+    def __init__(self, name, directions=None, products=None, lines=None, count=NUM_DEPARTURES_TO_FETCH):
+        """Initialize the view."""
+        self.name = name
+        self.directions = frozenset(map(_fold, directions)) if directions else None
+        self.products = frozenset(map(_fold, products)) if products else None
+        self.lines = frozenset(map(_fold, lines)) if lines else None
+        self.count = count
+
+    def filters(self):
+        """Returns (index key, values) of the filters that are set."""
+        return [
+            (key, values)
+            for key, values in (("direction", self.directions), ("product", self.products), ("line", self.lines))
+            if values is not None
+        ]
+
+    def matches(self, departure):
+        """Whether a Departure record matches all filters."""
+        return (
+            (self.directions is None or _fold(departure.direction) in self.directions)
+            and (self.products is None or _fold(departure.product) in self.products)
+            and (self.lines is None or _fold(departure.line_name) in self.lines)
+        )
+
+
+class DepartureIndex:
+    """
+    The departures of a timetable sorted by time, with the positions of the departures per
+    destination, transit type and line. A view only visits departures of its most selective
+    filter, starting at the first departure that is still reachable.
+    """
+
+    def __init__(self, timetable):
+        """Builds the index of a timetable."""
+        self.source = timetable
+        self.departures = sorted(timetable, key=attrgetter("when")) # Stable, departures at the same time keep the API order
+        self.whens = [departure.when for departure in self.departures]
+        self._positions = {"direction": {}, "product": {}, "line": {}}
+        for position, departure in enumerate(self.departures):
+            self._positions["direction"].setdefault(_fold(departure.direction), []).append(position)
+            self._positions["product"].setdefault(_fold(departure.product), []).append(position)
+            self._positions["line"].setdefault(_fold(departure.line_name), []).append(position)
+
+    def select(self, view, now, min_due_in):
+        """
+        Returns the first 'view.count' departures of a view that leave after now and at least
+        min_due_in minutes from now, as (due_in, Departure) pairs ordered by time.
+        """
+        start = max(bisect.bisect_right(self.whens, now), bisect.bisect_left(self.whens, now + min_due_in * 60))
+        filters = view.filters()
+        if filters:
+            # Walk the positions of the filter with the fewest departures, the others are checked per departure
+            lists = min(
+                ([self._positions[key].get(value, []) for value in values] for key, values in filters),
+                key=lambda lists: sum(map(len, lists)),
+            )
+            positions = heapq.merge(*(positions[bisect.bisect_left(positions, start):] for positions in lists))
+        else:
+            positions = range(start, len(self.departures))
+
+        connections = []
+        for position in positions:
+            departure = self.departures[position]
+            if view.matches(departure):
+                connections.append((int((departure.when - now) // 60), departure))
+                if len(connections) == view.count:
+                    break
+        return connections
+
+
+# Shared fetchers, keyed by (stop_id, direction_id, duration, endpoints, streaming)
+_FETCHERS = {}
+
+
+def get_fetcher(stop_id, direction_id, duration, endpoints=(DEFAULT_ENDPOINT,), streaming=False):
+    """
+    Returns the shared fetcher for a stop, direction and duration on a list of endpoints.
+    Streaming sensors get their own fetcher, the others always receive the whole window.
+    """
+    key = (stop_id, direction_id, duration, tuple(endpoints), streaming)
+    if key not in _FETCHERS:
+        # Transit types are filtered locally, so sensors only differing by transit_type share a request
+        if direction_id is None:
+            path = "/stops/{}/departures?duration={}".format(stop_id, duration)
+        else:
+            path = "/stops/{}/departures?direction={}&duration={}".format(stop_id, direction_id, duration)
+        _FETCHERS.setdefault(key, DepartureFetcher(path, [get_endpoint(endpoint) for endpoint in endpoints], streaming))
+    return _FETCHERS[key]
+
+
+class CacheWriter:
+    """Writes departures to a cache file in the background, at most once per flush interval."""
+
+    def __init__(self, hass, path, flush_interval, cache_format=CACHE_FORMAT_JSON):
+        """Initialize the writer."""
+        self.hass = hass
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_format = cache_format
+        self._pending = None # Latest (data, timetable) that still has to be written
+        self._digest = None # Hash of the content last written to the file
+        self._flushed_at = None # time.monotonic() of the last flush
+        self._unsub_flush = None
+        self._lock = asyncio.Lock() # One write at a time, the shutdown flush waits for a write in progress
+        # Don't lose the pending data on shutdown
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._async_flush)
+
+    @callback
+    def schedule(self, data, timetable):
+        """
+        Queues data and its parsed timetable for writing, only the latest data queued within the
+        flush interval is written. The binary format only stores the timetable.
+        """
+        self._pending = (data, timetable)
+        if self._unsub_flush is not None:
+            return # A flush is already scheduled and will pick up the latest data
+        delay = 0
+        if self._flushed_at is not None:
+            delay = max(0, self._flushed_at + self.flush_interval - time.monotonic())
+        self._unsub_flush = async_call_later(self.hass, delay, self._async_flush)
+
+    async def _async_flush(self, _=None):
+        """Writes the pending data in the executor."""
+        if self._unsub_flush is not None:
+            self._unsub_flush()
+            self._unsub_flush = None
+        async with self._lock:
+            pending, self._pending = self._pending, None
+            if pending is None:
+                return
+            self._flushed_at = time.monotonic()
+            await self.hass.async_add_executor_job(self._write, *pending)
+
+    def _write(self, data, timetable):
+        """Writes data to the cache file via a temporary file, skipping unchanged content."""
+        if self.cache_format == CACHE_FORMAT_BINARY:
+            content = encode_departures(timetable)
+        else:
+            content = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        digest = hashlib.sha1(content).digest()
+        if digest == self._digest:
+            _LOGGER.debug(f"Cache file {self.path} is unchanged, skipping write.")
+            return
+        temp_path = None
+        try:
+            # A temporary file of its own, a write can never mix with another one
+            handle, temp_path = tempfile.mkstemp(
+                prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", dir=os.path.dirname(self.path)
+            )
+            with os.fdopen(handle, "wb") as fd:
+                fd.write(content)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(temp_path, self.path) # Atomic, a crash never leaves a half written cache file
+            temp_path = None
+            self._digest = digest
+        except IOError as e:
+            _LOGGER.error(
+                f"Could not write cache file to {self.path}. Check configuration and permissions."
+            )
+            _LOGGER.error(f"I/O error({e.errno}): {e.strerror}")
+        except Exception as e: # Catch other potential errors during file write
+            _LOGGER.error(f"Error writing data to cache file: {e}")
+        finally:
+            if temp_path is not None: # Not moved into place
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+
+# Shared cache writers, keyed by cache file path
+_CACHE_WRITERS = {}
+
+
+def get_cache_writer(hass, path, flush_interval, cache_format=CACHE_FORMAT_JSON):
+    """Returns the shared cache writer for a cache file."""
+    if path not in _CACHE_WRITERS:
+        _CACHE_WRITERS[path] = CacheWriter(hass, path, flush_interval, cache_format)
+    return _CACHE_WRITERS[path]
+
+
+class OfflineCache:
+    """
+    Parsed cache files kept in memory, so offline polls don't read and parse the file again.
+    A file is only reloaded if its modification time or size changed. Both cache formats are
+    read, the format is detected from the file's header.
+    """
+
+    def __init__(self, max_entries):
+        """Initialize the cache."""
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # path -> (mtime_ns, size, data, timetable), least recently used first
+        self._lock = threading.Lock() # Files are read in executor threads
+
+    def get(self, path):
+        """
+        Returns the (mtime_ns, size, data, timetable) entry of a cache file and whether the file
+        had to be loaded. Runs in the executor. Raises FileNotFoundError if there is no cache file.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._entries.move_to_end(path)
+                return entry, False
+
+        with open(path, "rb") as fd:
+            if fd.read(len(BINARY_CACHE_MAGIC)) == BINARY_CACHE_MAGIC:
+                # Records are decoded straight from the mapped file
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as buffer:
+                    timetable = decode_departures(buffer)
+                # Already records, a payload in the API's format isn't needed by the sensor
+                data = {"departures": timetable}
+            else:
+                # Decoded one departure at a time, only the records and the fields the sensor uses are kept
+                fd.seek(0)
+                parser = DepartureStreamParser()
+                timetable = []
+                for chunk in iter(lambda: fd.read(STREAM_CHUNK_SIZE), b""):
+                    timetable.extend(filter(None, map(parse_departure, parser.feed(chunk))))
+                parser.close()
+                data = {"departures": [departure.as_dict() for departure in timetable]}
+        entry = (stat.st_mtime_ns, stat.st_size, data, timetable)
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # Evict the least recently used stop
+        return entry, True
+
+
+_OFFLINE_CACHE = OfflineCache(MAX_OFFLINE_CACHE_ENTRIES)
+
+
+class BatchUpdater:
+    """
+    Updates the sensors of the batch mode in one scheduled run per SCAN_INTERVAL, with bounded
+    concurrency, instead of a poll timer per sensor. Only changed states are written.
+    """
+
+    def __init__(self, hass, sensors, max_concurrency=BATCH_MAX_CONCURRENCY):
+        """Initialize the updater."""
+        self.hass = hass
+        self.sensors = sensors
+        self.max_concurrency = max_concurrency
+        self._unsub = None
+        self._unsub_startup = None
+
+    @callback
+    def async_start(self):
+        """Starts the scheduled updates, the first one after STARTUP_DELAY."""
+        self._unsub_startup = async_call_later(self.hass, STARTUP_DELAY, self.async_update)
+        self._unsub = async_track_time_interval(self.hass, self.async_update, SCAN_INTERVAL)
+        self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self.async_stop)
+
+    @callback
+    def async_stop(self, _=None):
+        """Stops the scheduled updates."""
+        if self._unsub_startup is not None:
+            self._unsub_startup()
+            self._unsub_startup = None
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+    async def async_update(self, _=None):
+        """Updates all sensors, then writes the states that changed."""
+        self._unsub_startup = None
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def update(sensor):
+            async with semaphore:
+                await sensor.async_update()
+
+        results = await asyncio.gather(*(update(sensor) for sensor in self.sensors), return_exceptions=True)
+        for sensor, result in zip(self.sensors, results):
+            if isinstance(result, Exception):
+                _LOGGER.error(f"Update for sensor {sensor.name} failed: {result}")
+            elif sensor._changed and sensor.entity_id is not None:
+                sensor.async_write_ha_state()
+
+
+def create_sensor(hass, config, should_poll=True):
+    """Creates a sensor from a platform or batch stop config."""
+    refresh_interval = config.get(CONF_REFRESH_INTERVAL)
+    return BvgSensor(
+        config.get(CONF_NAME),
+        config[CONF_STOP_ID],
+        config.get(CONF_DIRECTION_ID),
+        config.get(CONF_TRANS_TYPE_RESTRICTION),
+        config.get(CONF_MIN_DUE_IN),
+        config.get(CONF_CACHE_PATH),
+        hass,
+        config.get(CONF_CACHE_SIZE),
+        config.get(CONF_CACHE_FLUSH_INTERVAL),
+        refresh_interval,
+        config.get(CONF_MAX_REFRESH_INTERVAL, refresh_interval),
+        config.get(CONF_NUM_DEPARTURES),
+        config.get(CONF_SLIM_DEPARTURES),
+        should_poll,
+        config.get(CONF_DIAGNOSTICS),
+        config.get(CONF_STREAMING),
+        config.get(CONF_CACHE_FORMAT),
+        config.get(CONF_VIEWS),
+        config.get(CONF_ENDPOINTS),
+    )
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Setup the sensor platform."""
+    if CONF_STOPS not in config:
+        async_add_entities([create_sensor(hass, config)])
+        return
+
+    # Batch mode: all stops of this platform config are updated together by one timer.
+    # The platform's name and direction belong to its own stop, other stops only share the options
+    shared = {key: value for key, value in config.items() if key not in (CONF_STOP_ID, CONF_DIRECTION_ID, CONF_NAME)}
+    stops = ([config] if CONF_STOP_ID in config else []) + [
+        {**shared, CONF_NAME: "BVG {}".format(stop[CONF_STOP_ID]), **stop} for stop in config[CONF_STOPS]
+    ]
+    sensors = [create_sensor(hass, stop, should_poll=False) for stop in stops]
+    async_add_entities(sensors)
+    BatchUpdater(hass, sensors).async_start()
+
+
 class BvgSensor(Entity):
     """Representation of a Sensor."""
 
     def __init__(
-        self, name, stop_id, direction_id, transit_type, min_due_in, file_path, hass, cache_size
+        self, name, stop_id, direction_id, transit_type, min_due_in, file_path, hass, cache_size,
+        cache_flush_interval=DEFAULT_CACHE_FLUSH_INTERVAL, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+        max_refresh_interval=None, num_departures=NUM_DEPARTURES_TO_FETCH, slim_departures=False, should_poll=True,
+        diagnostics=False, streaming=False, cache_format=CACHE_FORMAT_JSON, views=None,
+        endpoints=None
     ):
         """Initialize the sensor."""
         self.hass_config = hass.config.as_dict()
         self._cache_size = cache_size
-        self._cache_creation_date = None
-        self._isCacheValid = True # Note: This variable's usage in getSingleConnection seems to be for logging based on cache age.
+        self._cache_created_at = None # Epoch seconds when the data was fetched or cached
         self._timezone = self.hass_config.get("time_zone")
+        self._tz = self.getTimezone() # Resolved once, only needed to render departure times
         self._name = name
+        self._attr_should_poll = should_poll # Sensors of the batch mode are updated by a BatchUpdater
         self._state = "n/a" # Default state
         self._stop_id = stop_id
         self._direction_id = direction_id
         self._transit_type = transit_type
         self.min_due_in = min_due_in
-        # API URL construction for fetching departures
-        self.url = "https://v6.bvg.transport.rest/stops/{}/departures?direction={}&duration={}".format(
-            self._stop_id, self._direction_id, self._cache_size
+        self._refresh_interval = refresh_interval
+        # The refresh interval adapts to the fetched departures if a larger maximum is configured
+        self._max_refresh_interval = max(refresh_interval, max_refresh_interval or refresh_interval)
+        self._next_refresh = None # time.monotonic() when the departures are fetched again
+        self._delays = {} # Delays by trip of the last refresh, to notice changing delays
+        # Departures are requested once per stop and direction for all sensors sharing them
+        self._fetcher = get_fetcher(
+            self._stop_id, self._direction_id, self._cache_size, endpoints or [DEFAULT_ENDPOINT], bool(streaming)
         )
-        # Apply transit type restriction if specified
-        if self._transit_type is not None:
-            for mode in TRANSIT_TYPES:
-                if mode == self._transit_type.lower():
-                    self.url += f"&{mode}=true"
-                else:
-                    self.url += f"&{mode}=false"
+        self.url = self._fetcher.url
+        # Views select from all departures of the stop, not only the transit type of the sensor
+        self._views = [
+            DepartureView(
+                view[CONF_NAME], view.get(CONF_DIRECTIONS), view.get(CONF_TRANS_TYPE_RESTRICTION),
+                view.get(CONF_LINES), view.get(CONF_NUM_DEPARTURES, num_departures),
+            )
+            for view in views or []
+        ]
+        self._view_departures = {} # View name -> list of (due_in, Departure) pairs
+        self._index = None # DepartureIndex of self._source_timetable, built for the views
+        self._source_timetable = [] # Departure records of self.data before the transit type restriction
+        # The departures must last until the next refresh, when due_in has been recomputed locally
+        for view in [DepartureView(name, products=[transit_type] if transit_type else None, count=num_departures)] + self._views:
+            self._fetcher.subscribe(view, min_due_in * 60 + self._max_refresh_interval)
+        # Transit type restriction is applied locally to the shared departures
+        if self._transit_type is not None and self._transit_type.lower() not in TRANSIT_TYPES:
+            _LOGGER.warning(f"Unknown transit type {self._transit_type} for sensor {self._name}. Valid options are: {TRANSIT_TYPES}")
         
         self.data = None  # Holds the raw JSON response from the API or cache
-        self.departures = [] # List to store processed departure data (dictionaries)
+        self.departures = [] # List of (due_in, Departure) pairs, the Departure is None for placeholders
+        self._num_departures = num_departures
+        self._slim_departures = slim_departures # Leave out what's repeated in every departure
+        self._attributes = None # State attributes, built once per update
+        self._changed = True # Whether the last update changed the state or attributes
+        # Diagnostics, only exposed as attribute if enabled
+        self._diagnostics = diagnostics
+        self._select_time = None # Seconds spent selecting the departures from the timetable
+        self._cache_hits = 0 # Offline reads served from memory
+        self._cache_misses = 0 # Offline reads that loaded the cache file
+        self._consecutive_failures = 0
+        self._stop_name = stop_id # Stop name shown for placeholders
+        self._source_stop_name = None # Stop name of the first departure of self.data
+        self._timetable = [] # Departure records of self.data
+        self._timetable_source = None # The payload self._timetable was built from
         
         self.file_path = os.path.join(self.hass_config.get("config_dir", ""), file_path) # Ensure config_dir is present
-        self.file_name = "bvg_{}.json".format(stop_id)
-        self._con_state = {CONNECTION_STATE: CON_STATE_ONLINE} # Internal connection state tracking
+        self._cache_format = cache_format
+        # Streaming only keeps part of the window, it must not replace the whole window of other sensors
+        self.file_name = "bvg_{}{}.{}".format(
+            stop_id, "_streaming" if streaming else "", "bin" if cache_format == CACHE_FORMAT_BINARY else "json"
+        )
+        self._cache_writer = get_cache_writer(
+            hass, os.path.join(self.file_path, self.file_name), cache_flush_interval, cache_format
+        )
+        self._con_state = {} # Internal connection state tracking, reported offline until the first fetch succeeds
 
     @property
     def name(self):
@@ -159,11 +1224,25 @@ class BvgSensor(Entity):
     @property
     def extra_state_attributes(self):
         """Return the state attributes."""
-        attrs = {ATTR_CONNECTION_STATE: self._con_state.get(CONNECTION_STATE, CON_STATE_OFFLINE)}
+        if self._attributes is None:
+            self._attributes = self.buildAttributes()
+        return self._attributes
+
+    def buildAttributes(self):
+        """Builds the state attributes from the selected departures."""
+        attrs = {
+            ATTR_CONNECTION_STATE: self._con_state.get(CONNECTION_STATE, CON_STATE_OFFLINE),
+            ATTR_BREAKER_STATE: self._fetcher.breaker_state,
+        }
+
+        # The list of all departures. Each item is a dictionary.
+        # The keys within these dictionaries are ATTR_DESTINATION, ATTR_REAL_TIME, etc.
+        # ISO timestamps are only rendered here, once per update.
+        processed_departures = [self.getDepartureAttributes(due_in, departure) for due_in, departure in self.departures]
 
         # Populate top-level attributes from the first departure, if available
-        if self.departures: # Check if the departures list is not empty
-            first_departure = self.departures[0]
+        if processed_departures: # Check if the departures list is not empty
+            first_departure = processed_departures[0]
             attrs[ATTR_STOP_ID] = self._stop_id # Configured stop ID
             attrs[ATTR_STOP_NAME] = first_departure.get(ATTR_STOP_NAME)
             attrs[ATTR_DUE_IN] = first_departure.get(ATTR_DUE_IN)
@@ -184,20 +1263,20 @@ class BvgSensor(Entity):
             attrs[ATTR_TRANS_TYPE] = "n/a"
             attrs[ATTR_LINE_NAME] = "n/a"
 
-        # Add the list of all departures. Each item is a dictionary.
-        # The keys within these dictionaries are ATTR_DESTINATION, ATTR_REAL_TIME, etc.
-        processed_departures = []
-        for dep in self.departures:
-            processed_departures.append({
-                ATTR_DESTINATION: dep.get(ATTR_DESTINATION),
-                ATTR_REAL_TIME: dep.get(ATTR_REAL_TIME),
-                ATTR_DUE_IN: dep.get(ATTR_DUE_IN),
-                ATTR_DELAY: dep.get(ATTR_DELAY),
-                ATTR_TRIP_ID: dep.get(ATTR_TRIP_ID),
-                ATTR_STOP_NAME: dep.get(ATTR_STOP_NAME),
-                ATTR_TRANS_TYPE: dep.get(ATTR_TRANS_TYPE),
-                ATTR_LINE_NAME: dep.get(ATTR_LINE_NAME),
-            })
+        if self._diagnostics:
+            attrs[ATTR_DIAGNOSTICS] = self.getDiagnostics()
+
+        if self._views:
+            attrs[ATTR_VIEWS] = {
+                name: [self.getDepartureAttributes(due_in, departure) for due_in, departure in connections]
+                for name, connections in self._view_departures.items()
+            }
+
+        if self._slim_departures:
+            # The stop name is the same for all departures and already a top-level attribute
+            for departure in processed_departures + [d for view in attrs.get(ATTR_VIEWS, {}).values() for d in view]:
+                del departure[ATTR_STOP_NAME]
+                del departure[ATTR_TRIP_ID]
         attrs[ATTR_DEPARTURES] = processed_departures
         
         return attrs
@@ -210,138 +1289,167 @@ class BvgSensor(Entity):
     @property
     def icon(self):
         """Icon to use in the frontend, based on the first departure's type."""
-        if self.departures and self.departures[0] is not None:
-            return ICONS.get(self.departures[0].get(ATTR_TRANS_TYPE))
+        if self.departures and self.departures[0][1] is not None:
+            return ICONS.get(self.departures[0][1].product)
         else:
             return ICONS.get(None) # Default icon
 
-    def update(self):
+    async def async_update_ha_state(self, force_refresh=False):
+        """Update Home Assistant with the current state, skipping the state write if a refresh didn't change anything."""
+        if not force_refresh:
+            await super().async_update_ha_state(force_refresh)
+            return
+        try:
+            await self.async_device_update()
+        except Exception:
+            _LOGGER.exception(f"Update for {self.entity_id} fails")
+            return
+        if self._changed:
+            self.async_write_ha_state()
+
+    async def async_added_to_hass(self):
+        """
+        Shows the cached departures right away, with due_in recomputed for the current time,
+        and defers the first request so Home Assistant's startup doesn't wait for the API.
+        """
+        await self.hass.async_add_executor_job(self.fetchDataFromFile, True)
+        self.selectDepartures()
+        delay = STARTUP_DELAY
+        if self.should_poll:
+            # Sensors set up together don't all request at once, batch mode bounds its concurrency itself
+            delay += random.uniform(0, STARTUP_STAGGER)
+            self.async_on_remove(async_call_later(self.hass, delay, self._async_startup_refresh))
+        self._next_refresh = time.monotonic() + delay
+
+    async def _async_startup_refresh(self, _now):
+        """Requests the departures for the first time."""
+        self.async_schedule_update_ha_state(True)
+
+    async def async_update(self):
         """Fetch new state data for the sensor.
         This is the only method that should fetch new data for Home Assistant.
         """
-        self.fetchDataFromURL() # Populates self.data with API response or cached data
-        
-        self.departures = [] # Clear previous departures
-        
-        # Check if data was successfully fetched and contains departures
+        now = time.monotonic()
+        refresh = self._next_refresh is None or now >= self._next_refresh - REFRESH_SLACK
+        if refresh:
+            await self.fetchDataFromURL() # Populates self.data with API response or cached data
+        else:
+            # Local tick between refreshes: no I/O and no parsing, due_in is recomputed from the fetched window
+            self.pruneTimetable()
+
+        self.selectDepartures()
+
+        if refresh:
+            self._next_refresh = now + self.getNextRefreshInterval()
+
+    def selectDepartures(self):
+        """Selects the next departures from the fetched timetable and builds the state and attributes."""
+        # Parse the fetched departures once, then pick the next valid ones in a single pass
         if self.data and self.data.get("departures"):
-            # getSingleConnection processes self.data to find the n-th valid departure
-            for i in range(NUM_DEPARTURES_TO_FETCH):
-                connection = self.getSingleConnection(self.min_due_in, i)
-                if connection:
-                    self.departures.append(connection)
-                else:
-                    # No valid departure found for this slot (i). Add a placeholder.
-                    _LOGGER.debug(f"No valid connection found for index {i} for sensor {self.name}. Adding placeholder.")
-                    placeholder_departure = {
-                        ATTR_DESTINATION: "n/a",
-                        ATTR_REAL_TIME: "n/a",
-                        ATTR_DUE_IN: "n/a", 
-                        ATTR_DELAY: 0, # Default to 0 for consistency
-                        ATTR_TRIP_ID: "n/a_placeholder", # Special marker for placeholder
-                        ATTR_STOP_NAME: self.data.get("departures")[0].get("stop", {}).get("name") if self.data.get("departures") else self._stop_id, # Try to get actual stop name, fallback
-                        ATTR_TRANS_TYPE: "n/a", # Will result in default clock icon
-                        ATTR_LINE_NAME: "n/a",
-                    }
-                    self.departures.append(placeholder_departure)
-                    # Continue to the next iteration of the loop
+            start = time.perf_counter() if self._diagnostics else None
+            self.departures = self.getConnections(self.min_due_in, self._num_departures)
+            if start is not None:
+                self._select_time = time.perf_counter() - start
+            self._stop_name = self._source_stop_name # Try to get actual stop name for placeholders
         else:
             _LOGGER.debug(f"No departure data available in self.data to process for sensor {self.name}. Filling all slots with placeholders.")
-            # If no data at all, fill all NUM_DEPARTURES_TO_FETCH slots with placeholders
-            for _ in range(NUM_DEPARTURES_TO_FETCH):
-                placeholder_departure = {
-                    ATTR_DESTINATION: "n/a",
-                    ATTR_REAL_TIME: "n/a",
-                    ATTR_DUE_IN: "n/a",
-                    ATTR_DELAY: 0,
-                    ATTR_TRIP_ID: "n/a_placeholder",
-                    ATTR_STOP_NAME: self._stop_id, # Fallback to configured stop_id
-                    ATTR_TRANS_TYPE: "n/a",
-                    ATTR_LINE_NAME: "n/a",
-                }
-                self.departures.append(placeholder_departure)
-            
+            self.departures = []
+            self._stop_name = self._stop_id # Fallback to configured stop_id
+
+        # No valid departure found for the remaining slots. Add placeholders.
+        for i in range(len(self.departures), self._num_departures):
+            _LOGGER.debug(f"No valid connection found for index {i} for sensor {self.name}. Adding placeholder.")
+            self.departures.append(("n/a", None))
+
         # Update the primary sensor state based on the first departure
         # (which could now be a placeholder)
-        if self.departures: # Should always be true now due to placeholder logic
-            first_departure = self.departures[0]
-            # If ATTR_DUE_IN is "n/a" (string from placeholder), state becomes "n/a"
-            # If it's an int (from a real departure), state is that int.
-            self._state = first_departure.get(ATTR_DUE_IN) 
-        else:
-            # This case should ideally not be reached if placeholders are always added
-            self._state = "n/a" 
+        # If due_in is "n/a" (string from placeholder), state becomes "n/a"
+        # If it's an int (from a real departure), state is that int.
+        previous_state = self._state
+        self._state = self.departures[0][0]
+
+        if self._views:
+            self._view_departures = self.getViews()
+
+        # Build the attributes once and remember whether anything changed since the last update
+        attributes = self.buildAttributes()
+        self._changed = self._state != previous_state or attributes != self._attributes
+        self._attributes = attributes
 
-    def fetchDataFromURL(self):
+    async def fetchDataFromURL(self):
         """Fetches data from the BVG API URL and handles caching."""
         try:
-            _LOGGER.debug(f"Attempting to open URL: {self.url}") # Changed to debug
-            with urlopen(self.url, timeout=5) as response:
-                source = response.read().decode("utf8") # Assuming utf8, as per original
-                self.data = json.loads(source)
-                if self._con_state.get(CONNECTION_STATE) == CON_STATE_OFFLINE: # Check current state before logging
-                    _LOGGER.warning("Connection to BVG API re-established")
-                self._con_state[CONNECTION_STATE] = CON_STATE_ONLINE # Update state
-                
-                # Write response to cache file
-                try:
-                    # _LOGGER.debug("Attempting to write to cache file: {}{}".format(self.file_path, self.file_name)) # Changed to debug
-                    # Ensure directory exists (optional, good practice if file_path can be deep)
-                    # os.makedirs(self.file_path, exist_ok=True) # If file_path is just a directory
-                    with open(os.path.join(self.file_path, self.file_name), "w", encoding="utf-8") as fd: # Added encoding
-                        json.dump(self.data, fd, ensure_ascii=False)
-                        self._cache_creation_date = datetime.now(
-                            pytz.timezone(self._timezone)
-                        )
-                except IOError as e:
-                    _LOGGER.error(
-                        f"Could not write cache file to {os.path.join(self.file_path, self.file_name)}. Check configuration and permissions."
-                    )
-                    _LOGGER.error(f"I/O error({e.errno}): {e.strerror}")
-                except Exception as e: # Catch other potential errors during file write
-                    _LOGGER.error(f"Error writing data to cache file: {e}")
+            data, timetable = await self._fetcher.fetch(async_get_clientsession(self.hass), SHARED_FETCH_MAX_AGE.total_seconds())
+            if self._con_state.get(CONNECTION_STATE) == CON_STATE_OFFLINE: # Check current state before logging
+                _LOGGER.warning("Connection to BVG API re-established")
+            self._con_state[CONNECTION_STATE] = CON_STATE_ONLINE # Update state
+            self._consecutive_failures = 0
 
-        except HTTPError as e: # Specific catch for HTTPError
-            _LOGGER.error(f"HTTPError fetching data: {e.code} - {e.reason}. URL: {self.url}")
+            # The payload is confirmed to be current, even if the API answered "not modified"
+            self._cache_created_at = time.time()
+            if data is not self.data: # Only a new response needs to be written to the cache
+                self.data = data
+                self.buildTimetable(timetable)
+                # Write response to cache file in the background
+                self._cache_writer.schedule(data, timetable)
+
+        except CircuitOpenError as e: # API host is failing, use the cache without waiting for it
+            self._consecutive_failures += 1
+            _LOGGER.debug(f"{e}, using local cache for sensor {self.name}.")
+            self._con_state[CONNECTION_STATE] = CON_STATE_OFFLINE
+            await self.hass.async_add_executor_job(self.fetchDataFromFile) # Load from cache
+        except aiohttp.ClientResponseError as e: # Specific catch for HTTP error status
+            self._consecutive_failures += 1
+            _LOGGER.error(f"HTTPError fetching data: {e.status} - {e.message}. URL: {self.url}")
             if self._con_state.get(CONNECTION_STATE) == CON_STATE_ONLINE:
                 _LOGGER.warning("Connection to BVG API lost (HTTPError), attempting to use local cache.")
             self._con_state[CONNECTION_STATE] = CON_STATE_OFFLINE
-            self.fetchDataFromFile() # Attempt to load from cache
-        except URLError as e: # Catch other URL related errors (timeout, DNS etc.)
-            _LOGGER.error(f"URLError fetching data: {e.reason}. URL: {self.url}")
+            await self.hass.async_add_executor_job(self.fetchDataFromFile) # Attempt to load from cache
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e: # Catch other connection related errors (timeout, DNS etc.)
+            self._consecutive_failures += 1
+            _LOGGER.error(f"URLError fetching data: {e!r}. URL: {self.url}")
             if self._con_state.get(CONNECTION_STATE) == CON_STATE_ONLINE:
                 _LOGGER.warning("Connection to BVG API lost (URLError), attempting to use local cache.")
             self._con_state[CONNECTION_STATE] = CON_STATE_OFFLINE
-            self.fetchDataFromFile() # Attempt to load from cache
+            await self.hass.async_add_executor_job(self.fetchDataFromFile) # Attempt to load from cache
         except json.JSONDecodeError as e:
+            self._consecutive_failures += 1
             _LOGGER.error(f"Error decoding JSON response from BVG API: {e}")
             self._con_state[CONNECTION_STATE] = CON_STATE_OFFLINE # Treat as offline if response is malformed
-            self.fetchDataFromFile() # Attempt to load from cache
+            await self.hass.async_add_executor_job(self.fetchDataFromFile) # Attempt to load from cache
         except Exception as e: # Generic catch-all for unexpected errors
+            self._consecutive_failures += 1
             _LOGGER.error(f"Unexpected error in fetchDataFromURL: {e}")
             # Potentially set to offline and try cache, depending on desired robustness
             # self._con_state[CONNECTION_STATE] = CON_STATE_OFFLINE
             # self.fetchDataFromFile()
 
-
-    def fetchDataFromFile(self):
-        """Fetches data from the local cache file."""
+    def fetchDataFromFile(self, priming=False):
+        """
+        Fetches data from the local cache file. Runs in the executor. When priming the sensor at
+        startup a missing file is expected, e.g. on a fresh install, and only logged at debug level.
+        """
         try:
             cache_file_full_path = os.path.join(self.file_path, self.file_name)
-            # _LOGGER.debug(f"Attempting to read from cache file: {cache_file_full_path}") # Changed to debug
-            if not os.path.exists(cache_file_full_path):
+            if self._cache_format == CACHE_FORMAT_BINARY and not os.path.exists(cache_file_full_path):
+                # Not written in the binary format yet, migrate from the JSON cache file
+                cache_file_full_path = os.path.join(self.file_path, os.path.splitext(self.file_name)[0] + ".json")
+            # The file is only read and parsed again if it changed on disk
+            (mtime_ns, _, self.data, timetable), loaded = _OFFLINE_CACHE.get(cache_file_full_path)
+            if loaded:
+                self._cache_misses += 1
+            else:
+                self._cache_hits += 1
+            self.buildTimetable(timetable)
+            # Update cache creation date from file modification time if not set by successful API call
+            if self._cache_created_at is None:
+                self._cache_created_at = mtime_ns / 1e9
+        except FileNotFoundError:
+            if priming:
+                _LOGGER.debug(f"No cache file yet: {cache_file_full_path}. Waiting for the first fetch.")
+            else:
                 _LOGGER.warning(f"Cache file not found: {cache_file_full_path}. No data loaded from cache.")
-                self.data = None # Ensure data is None if cache file doesn't exist
-                return
-
-            with open(cache_file_full_path, "r", encoding="utf-8") as fd: # Added encoding
-                self.data = json.load(fd)
-                # Update cache creation date from file modification time if not set by successful API call
-                if self._cache_creation_date is None:
-                    self._cache_creation_date = datetime.fromtimestamp(
-                        os.path.getmtime(cache_file_full_path),
-                        pytz.timezone(self._timezone)
-                    )
+            self.data = None # Ensure data is None if cache file doesn't exist
         except IOError as e:
             _LOGGER.error(
                 f"Could not read cache file from {os.path.join(self.file_path, self.file_name)}. Check configuration."
@@ -351,152 +1459,189 @@ class BvgSensor(Entity):
         except json.JSONDecodeError as e:
             _LOGGER.error(f"Error decoding JSON from cache file {os.path.join(self.file_path, self.file_name)}: {e}")
             self.data = None # Ensure data is None on error
+        except ValueError as e:
+            _LOGGER.error(f"Error decoding binary cache file {os.path.join(self.file_path, self.file_name)}: {e}")
+            self.data = None
         except Exception as e:
             _LOGGER.error(f"Unexpected error in fetchDataFromFile: {e}")
             self.data = None
 
 
-    def getSingleConnection(self, min_due_in, nmbr):
+    def getTimezone(self):
+        """Returns the configured timezone, falling back to UTC if it is unknown."""
+        if not self._timezone:
+            return dt_util.UTC # Fallback to UTC if not set
+        tz = dt_util.get_time_zone(self._timezone) # Already loaded by Home Assistant, no import at setup
+        if tz is None:
+            _LOGGER.error(f"Unknown timezone configured: {self._timezone}. Defaulting to UTC.")
+            return dt_util.UTC
+        return tz
+
+    def buildTimetable(self, timetable=None):
         """
-        Processes self.data (fetched from API/cache) and returns the 'nmbr'-th valid departure.
-        A departure is valid if it's not in the past and meets the min_due_in criteria.
+        Parses self.data (fetched from API/cache) once into self._timetable, a list of
+        Departure records, so later lookups don't re-parse anything.
+        An already parsed timetable of self.data can be passed in, it's only filtered then.
         """
+        if self._timetable_source is self.data:
+            return # Already parsed this payload
+        self._timetable_source = self.data
+        self._timetable = []
+        self._source_timetable = []
+
         if not self.data or "departures" not in self.data:
-            _LOGGER.debug(f"getSingleConnection: No self.data or no 'departures' key in self.data for sensor {self.name}.")
-            return None
+            _LOGGER.debug(f"buildTimetable: No self.data or no 'departures' key in self.data for sensor {self.name}.")
+            return
 
-        timetable_l = list()
-        # Ensure timezone is correctly obtained for 'now'
-        try:
-            current_timezone = pytz.timezone(self._timezone if self._timezone else "UTC") # Fallback to UTC if not set
-        except pytz.exceptions.UnknownTimeZoneError:
-            _LOGGER.error(f"Unknown timezone configured: {self._timezone}. Defaulting to UTC.")
-            current_timezone = pytz.timezone("UTC")
-        
-        date_now = datetime.now(current_timezone)
+        if timetable is None:
+            timetable = parse_departures(self.data)
+        self._source_timetable = timetable
+        self._source_stop_name = timetable[0].stop_name if timetable else self._stop_id
+        transit_type = self._transit_type.lower() if self._transit_type is not None else None
+        if transit_type is None:
+            self._timetable = timetable
+        else:
+            # Restricted to a transit type
+            self._timetable = [departure for departure in timetable if departure.product == transit_type]
 
-        for pos in self.data["departures"]:
-            if pos.get("when") is None: # Departure time is missing
-                _LOGGER.debug(f"Skipping entry due to missing 'when' field: {pos.get('tripId', 'Unknown Trip')}")
-                continue
-            
-            try:
-                # Parse ISO 8601 datetime string (e.g., "2023-05-01T10:00:00+02:00")
-                # The API provides timezone-aware strings.
-                dep_time_naive_str = pos["when"]
-                # Try to parse with timezone, then without if it fails (older formats might exist)
-                try:
-                    dep_time = datetime.fromisoformat(dep_time_naive_str)
-                except ValueError: # Handle cases like "2024-05-07T10:00:00" (naive)
-                    dep_time_naive = datetime.strptime(dep_time_naive_str.split('+')[0].split('Z')[0], "%Y-%m-%dT%H:%M:%S")
-                    # Assume Berlin timezone for naive times from BVG API, then convert to user's configured timezone
-                    dep_time_berlin = pytz.timezone("Europe/Berlin").localize(dep_time_naive)
-                    dep_time = dep_time_berlin.astimezone(current_timezone)
-
-                # Ensure dep_time is timezone-aware for comparison with date_now
-                if dep_time.tzinfo is None or dep_time.tzinfo.utcoffset(dep_time) is None:
-                    _LOGGER.warning(f"Departure time for trip {pos.get('tripId')} is naive. Assuming Europe/Berlin.")
-                    dep_time = pytz.timezone("Europe/Berlin").localize(dep_time).astimezone(current_timezone)
-                else:
-                    # Convert to the system's timezone if different for consistent comparison
-                    dep_time = dep_time.astimezone(current_timezone)
-
-            except ValueError as e:
-                _LOGGER.error(f"Could not parse departure time string: {pos['when']}. Error: {e}. Skipping entry.")
-                continue
-
-            delay = (pos.get("delay", 0) // 60) if pos.get("delay") is not None else 0 # Delay in minutes
-            
-            # Calculate difference in minutes
-            if dep_time > date_now:
-                departure_td_total_seconds = (dep_time - date_now).total_seconds()
-                departure_minutes = departure_td_total_seconds // 60
-                
-                if departure_minutes >= min_due_in:
-                    timetable_l.append(
-                        {
-                            ATTR_DESTINATION: pos.get("direction"),
-                            ATTR_REAL_TIME: dep_time.isoformat(), # Store as ISO string
-                            ATTR_DUE_IN: int(departure_minutes),
-                            ATTR_DELAY: delay,
-                            ATTR_TRIP_ID: pos.get("tripId"),
-                            ATTR_STOP_NAME: pos.get("stop", {}).get("name"),
-                            ATTR_TRANS_TYPE: pos.get("line", {}).get("product"),
-                            ATTR_LINE_NAME: pos.get("line", {}).get("name"),
-                        }
-                    )
-                    # _LOGGER.debug("Valid connection added to timetable_l.")
-                else:
+    def getConnections(self, min_due_in, count):
+        """
+        Returns up to 'count' valid departures from the parsed timetable as (due_in, Departure)
+        pairs, ordered by due_in.
+        A departure is valid if it's not in the past and meets the min_due_in criteria.
+        """
+        self.buildTimetable()
+        now = time.time()
+
+        def candidates():
+            for index, departure in enumerate(self._timetable):
+                if departure.when <= now:
+                    _LOGGER.debug(f"Connection {departure.line_name} to {departure.direction} is in the past. Skipping.")
+                    continue
+                departure_minutes = int((departure.when - now) // 60)
+                if departure_minutes < min_due_in:
                     _LOGGER.debug(
-                        f"Connection {pos.get('line', {}).get('name')} to {pos.get('direction')} is due in {departure_minutes} min (less than {min_due_in} min walking distance). Skipping."
+                        f"Connection {departure.line_name} to {departure.direction} is due in {departure_minutes} min (less than {min_due_in} min walking distance). Skipping."
                     )
-            else:
-                _LOGGER.debug(f"Connection {pos.get('line', {}).get('name')} to {pos.get('direction')} is in the past. Skipping.")
-        
-        # Sort timetable by due_in to ensure correct order if API doesn't guarantee it
-        timetable_l.sort(key=lambda x: x[ATTR_DUE_IN])
+                    continue
+                # The index keeps the API order for departures due in the same minute
+                yield departure_minutes, index
 
-        try:
-            # _LOGGER.debug(f"Timetable for getSingleConnection(nmbr={nmbr}): {timetable_l}")
-            return timetable_l[int(nmbr)]
-        except IndexError:
-            # This is expected if fewer than 'nmbr' departures are found.
-            # The logging for "No valid connection found" might be too noisy if it happens often.
-            # The self._isCacheValid logic here seems to be for determining if a warning is needed.
+        # Bounded selection instead of sorting the whole window, the API doesn't guarantee order
+        connections = [
+            (departure_minutes, self._timetable[index])
+            for departure_minutes, index in heapq.nsmallest(count, candidates())
+        ]
+
+        if len(connections) < count:
+            # This is expected if fewer than 'count' departures are found.
+            # Only log warning if cache is also outdated.
             if self.isCacheValid(): # isCacheValid checks if the cache file is recent
                 _LOGGER.debug(
-                    f"No valid connection found for index {nmbr} for sensor {self.name}. This is normal if fewer than {NUM_DEPARTURES_TO_FETCH} departures are available."
+                    f"Only {len(connections)} valid connections found for sensor {self.name}. This is normal if fewer than {count} departures are available."
                 )
-                # self._isCacheValid = True # This line seems redundant as isCacheValid() doesn't change state.
             else:
-                # Only log warning if cache is also outdated.
-                if self._isCacheValid: # This condition will be false if isCacheValid() returned false.
-                    _LOGGER.warning(f"Cache is outdated for sensor {self.name}, and no connection found at index {nmbr}.")
-                # self._isCacheValid = False # This variable's state management might need review if it's critical.
-            return None
-        except Exception as e:
-            _LOGGER.error(f"Unexpected error in getSingleConnection when accessing timetable_l: {e}")
-            return None
+                _LOGGER.warning(f"Cache is outdated for sensor {self.name}, and only {len(connections)} connections found.")
+        return connections
+
+    def getViews(self):
+        """Returns the departures of each view from the index of the fetched departures."""
+        if self._index is None or self._index.source is not self._source_timetable:
+            self._index = DepartureIndex(self._source_timetable)
+        now = time.time()
+        return {view.name: self._index.select(view, now, self.min_due_in) for view in self._views}
+
+    def getNextRefreshInterval(self):
+        """
+        Picks the seconds until the next API request from the fetched departures, between
+        refresh_interval and max_refresh_interval. Refreshes often while the next departure is
+        about to drop below walking_distance or delays change, and backs off while the next
+        reachable departure is far away, e.g. at night.
+        """
+        if self._max_refresh_interval <= self._refresh_interval:
+            return self._refresh_interval
+
+        delays = {departure.trip_id: departure.delay for _, departure in self.departures if departure is not None}
+        delays_changed = any(self._delays.get(trip_id, delay) != delay for trip_id, delay in delays.items())
+        self._delays = delays
+
+        if self._con_state.get(CONNECTION_STATE) == CON_STATE_OFFLINE:
+            return self._refresh_interval # Retry soon while running on cached data
+        if self.departures[0][1] is None:
+            return self._max_refresh_interval # Nothing reachable in the fetched window
+        if delays_changed:
+            return self._refresh_interval
+
+        # Minutes until the next departure can't be reached anymore
+        slack = self.departures[0][0] - self.min_due_in
+        if slack <= ADAPTIVE_NEAR_THRESHOLD:
+            return self._refresh_interval
+        # Check again halfway there, but before the fetched window runs out
+        interval = slack * 60 / 2
+        window_end = max(departure.when for departure in self._timetable)
+        interval = min(interval, window_end - time.time() - self.min_due_in * 60)
+        return min(max(interval, self._refresh_interval), self._max_refresh_interval)
+
+    def pruneTimetable(self):
+        """Drops departed trains from the fetched window."""
+        now = time.time()
+        if any(departure.when <= now for departure in self._timetable):
+            # The timetable may be shared with other sensors, so it's replaced instead of modified
+            self._timetable = [departure for departure in self._timetable if departure.when > now]
+
+    def getDiagnostics(self):
+        """Returns timings (milliseconds) and counters of the update stages."""
+        def milliseconds(seconds):
+            return round(seconds * 1000, 1) if seconds is not None else None
+
+        return {
+            "endpoint": self._fetcher.endpoint,
+            "fetch_time": milliseconds(self._fetcher.fetch_time),
+            "bytes_received": self._fetcher.bytes_received,
+            "parse_time": milliseconds(self._fetcher.parse_time),
+            "select_time": milliseconds(self._select_time),
+            "departures_scanned": len(self._timetable),
+            "departures_kept": sum(1 for _, departure in self.departures if departure is not None),
+            "cache_hits": self._cache_hits,
+            "cache_misses": self._cache_misses,
+            "consecutive_failures": self._consecutive_failures,
+        }
+
+    def getDepartureAttributes(self, due_in, departure):
+        """Renders a departure as attribute dictionary, or a placeholder if departure is None."""
+        if departure is None:
+            return {
+                ATTR_DESTINATION: "n/a",
+                ATTR_REAL_TIME: "n/a",
+                ATTR_DUE_IN: "n/a",
+                ATTR_DELAY: 0, # Default to 0 for consistency
+                ATTR_TRIP_ID: "n/a_placeholder", # Special marker for placeholder
+                ATTR_STOP_NAME: self._stop_name,
+                ATTR_TRANS_TYPE: "n/a", # Will result in default clock icon
+                ATTR_LINE_NAME: "n/a",
+            }
+        return {
+            ATTR_DESTINATION: departure.direction,
+            ATTR_REAL_TIME: datetime.fromtimestamp(departure.when, self._tz).isoformat(), # Rendered as ISO string
+            ATTR_DUE_IN: due_in,
+            ATTR_DELAY: departure.delay,
+            ATTR_TRIP_ID: departure.trip_id,
+            ATTR_STOP_NAME: departure.stop_name,
+            ATTR_TRANS_TYPE: departure.product,
+            ATTR_LINE_NAME: departure.line_name,
+        }
 
 
     def isCacheValid(self):
         """Checks if the cache file is considered recent based on CONF_CACHE_SIZE."""
-        # If _cache_creation_date is not set (e.g., first run, no API success yet),
-        # try to get it from file modification time.
-        if self._cache_creation_date is None:
-            try:
-                cache_file_full_path = os.path.join(self.file_path, self.file_name)
-                if os.path.exists(cache_file_full_path):
-                    self._cache_creation_date = datetime.fromtimestamp(
-                        os.path.getmtime(cache_file_full_path),
-                        pytz.timezone(self._timezone if self._timezone else "UTC") # Fallback for timezone
-                    )
-                else:
-                    _LOGGER.debug("isCacheValid: Cache file does not exist, cannot determine creation date from file.")
-                    return False # No cache, so it's not "valid" in terms of being recent data.
-            except pytz.exceptions.UnknownTimeZoneError:
-                _LOGGER.error(f"Unknown timezone for cache validation: {self._timezone}. Cannot validate cache age accurately.")
-                return False # Cannot validate if timezone is broken
-            except Exception as e:
-                _LOGGER.error(f"Error accessing cache file modification time: {e}")
-                return False # Assume not valid if we can't check.
-
-        if self._cache_creation_date is None: # Still None after trying file mod time
-            _LOGGER.debug("isCacheValid: _cache_creation_date is None, cache is not considered valid.")
+        # _cache_created_at is set when data is fetched from the API or read from the cache file,
+        # so no file access is needed here.
+        if self._cache_created_at is None:
+            _LOGGER.debug("isCacheValid: _cache_created_at is None, cache is not considered valid.")
             return False
 
-        # Ensure timezone for 'now'
-        try:
-            current_timezone = pytz.timezone(self._timezone if self._timezone else "UTC")
-        except pytz.exceptions.UnknownTimeZoneError:
-            _LOGGER.error(f"Unknown timezone for cache validation (now): {self._timezone}. Defaulting to UTC.")
-            current_timezone = pytz.timezone("UTC")
-
-        date_now = datetime.now(current_timezone)
-        
         # Calculate age of cache
-        cache_age_delta = date_now - self._cache_creation_date
-        cache_age_seconds = cache_age_delta.total_seconds()
+        cache_age_seconds = time.time() - self._cache_created_at
         
         # Cache is valid if its age in seconds is less than or equal to cache_size in minutes * 60
         # And age must be positive (cache_creation_date should not be in the future)
@@ -505,7 +1650,7 @@ class BvgSensor(Entity):
             return True
         else:
             if cache_age_seconds < 0:
-                _LOGGER.warning(f"Cache creation date ({self._cache_creation_date}) is in the future compared to now ({date_now}). Assuming cache is not valid.")
+                _LOGGER.warning(f"Cache creation date ({datetime.fromtimestamp(self._cache_created_at, self._tz)}) is in the future. Assuming cache is not valid.")
             else:
                 _LOGGER.debug(f"Cache is outdated. Age: {cache_age_seconds // 60} minutes (Max allowed: {self._cache_size} minutes).")
             return False
@@ -0,0 +1,235 @@
+"""
+Shared helpers of the tests and benchmarks: loads sensor.py without a Home Assistant instance,
+provides a stub hass, departures payloads in the v6 API format and a stand-in API server.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+BERLIN = timezone(timedelta(hours=2))
+
+LINES = [
+    ("S5", "suburban", "S Westkreuz"), ("S7", "suburban", "S Potsdam Hauptbahnhof"), ("S9", "suburban", "S Flughafen BER"),
+    ("RE1", "regional", "Frankfurt (Oder), Bahnhof"), ("RB23", "regional", "Flughafen BER"),
+    ("ICE 1009", "express", "München Hbf"), ("M5", "tram", "Zingster Str."), ("M8", "tram", "Ahrensfelde/Stadtgrenze"),
+    ("M10", "tram", "S+U Warschauer Str."), ("120", "bus", "S+U Wittenau"), ("123", "bus", "U Mierendorffplatz"),
+    ("TXL", "bus", "Flughafen Tegel (Airport)"), ("245", "bus", "Nordbahnhof"), ("U5", "subway", "U Hönow"),
+]
+
+
+def load_sensor():
+    """Loads a fresh copy of sensor.py, so the shared fetchers, breakers and caches start empty."""
+    spec = importlib.util.spec_from_file_location("bvg_sensor_under_test", os.path.join(ROOT, "sensor.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_payload(count, start=None, seed=0, step=6, stop_name="S+U Berlin Hauptbahnhof"):
+    """
+    Builds a departures payload in the v6 format with 'count' departures, about 'step' seconds
+    apart from 'start' on, ordered by planned time like the API's responses.
+    """
+    rng = random.Random(seed)
+    start = start or datetime.now(BERLIN).replace(microsecond=0)
+    departures = []
+    for index in range(count):
+        name, product, direction = rng.choice(LINES)
+        planned = start + timedelta(seconds=step * index + rng.randint(0, step))
+        delay = rng.choice([None, 0, 0, 60, 120, 300, -60])
+        when = planned + timedelta(seconds=delay or 0)
+        departures.append({
+            "tripId": f"1|{20000 + index}|{rng.randint(0, 40)}|86|{start:%d%m%Y}",
+            "stop": {
+                "type": "stop", "id": "900003201", "name": stop_name,
+                "location": {"type": "location", "id": "900003201", "latitude": 52.525592, "longitude": 13.369545},
+                "products": {p: True for p in ("suburban", "subway", "tram", "bus", "ferry", "express", "regional")},
+            },
+            "when": when.isoformat(),
+            "plannedWhen": planned.isoformat(),
+            "delay": delay,
+            "platform": str(rng.randint(1, 16)),
+            "plannedPlatform": str(rng.randint(1, 16)),
+            "prognosisType": "prognosed",
+            "direction": direction,
+            "provenance": None,
+            "line": {
+                "type": "line", "id": name.lower().replace(" ", "-"), "fahrtNr": str(rng.randint(1000, 99999)),
+                "name": name, "public": True, "adminCode": "BVB---", "productName": name.split()[0],
+                "mode": "train" if product in ("suburban", "regional", "express", "subway") else product,
+                "product": product, "operator": {"type": "operator", "id": "berliner-verkehrsbetriebe", "name": "Berliner Verkehrsbetriebe"},
+            },
+            "remarks": [
+                {"type": "hint", "code": "bf", "text": "barrier-free"},
+                {"type": "hint", "code": "FK", "text": "Bicycle conveyance"},
+            ],
+            "origin": None,
+            "destination": {"type": "stop", "id": "900000000", "name": direction},
+            "currentTripPosition": {"type": "location", "latitude": 52.5 + rng.random() / 10, "longitude": 13.3 + rng.random() / 10},
+            "occupancy": rng.choice(["low", "medium", "high"]),
+        })
+    return {"departures": departures, "realtimeDataUpdatedAt": int(start.timestamp())}
+
+
+def shift_payload(payload, start):
+    """Returns a copy of a payload with its departure times moved so the first planned departure is at 'start'."""
+    payload = json.loads(json.dumps(payload))
+    first = datetime.fromisoformat(payload["departures"][0]["plannedWhen"])
+    offset = start - first
+    for departure in payload["departures"]:
+        for key in ("when", "plannedWhen"):
+            if departure.get(key) is not None:
+                departure[key] = (datetime.fromisoformat(departure[key]) + offset).isoformat()
+    return payload
+
+
+def load_fixture(name, start=None):
+    """Loads a payload of tests/fixtures, with departures starting now unless 'start' is given."""
+    with gzip.open(os.path.join(FIXTURES, f"{name}.json.gz"), "rt", encoding="utf-8") as fd:
+        payload = json.load(fd)
+    return shift_payload(payload, start or datetime.now(BERLIN).replace(microsecond=0))
+
+
+class StubConfig:
+    """The parts of hass.config the sensor uses."""
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+
+    def as_dict(self):
+        return {"time_zone": "Europe/Berlin", "config_dir": self.config_dir}
+
+
+class StubBus:
+    """Collects the listeners registered with async_listen_once."""
+
+    def __init__(self):
+        self.listeners = []
+
+    def async_listen_once(self, event_type, listener):
+        self.listeners.append((event_type, listener))
+        return lambda: self.listeners.remove((event_type, listener))
+
+    async def async_fire(self, event_type):
+        """Calls and awaits the listeners of an event."""
+        for registered, listener in list(self.listeners):
+            if registered == event_type:
+                result = listener(None)
+                if asyncio.iscoroutine(result):
+                    await result
+
+
+class StubHass:
+    """A minimal hass running executor jobs in the default executor of the running loop."""
+
+    def __init__(self, config_dir):
+        self.config = StubConfig(config_dir)
+        self.bus = StubBus()
+        self.loop = asyncio.get_running_loop()
+        self.executor_jobs = 0
+        self.tasks = []
+
+    def async_add_executor_job(self, target, *args):
+        self.executor_jobs += 1
+        return self.loop.run_in_executor(None, target, *args)
+
+    def async_create_task(self, coroutine, *args, **kwargs):
+        task = self.loop.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def async_block_till_done(self):
+        """Waits for the tasks created so far."""
+        while self.tasks:
+            tasks, self.tasks = self.tasks, []
+            await asyncio.gather(*tasks)
+
+
+def install_stubs(module, hass, session):
+    """Points the module's Home Assistant helpers to the stub hass and an aiohttp session."""
+    module.async_get_clientsession = lambda _hass: session
+
+    def async_call_later(_hass, delay, action):
+        handle = hass.loop.call_later(delay, lambda: hass.async_create_task(action(None)))
+        return handle.cancel
+
+    def async_track_time_interval(_hass, action, interval):
+        handle = None
+
+        def run():
+            nonlocal handle
+            hass.async_create_task(action(None))
+            handle = hass.loop.call_later(interval.total_seconds(), run)
+
+        handle = hass.loop.call_later(interval.total_seconds(), run)
+        return lambda: handle.cancel()
+
+    module.async_call_later = async_call_later
+    module.async_track_time_interval = async_track_time_interval
+
+
+def create_sensor(module, hass, **config):
+    """Creates a sensor from a validated platform config, options set to None are left out."""
+    config = {key: value for key, value in config.items() if value is not None}
+    config = module.PLATFORM_SCHEMA({"platform": "bvg", "file_path": ".", **config})
+    sensor = module.create_sensor(hass, config)
+    sensor.hass = hass
+    return sensor
+
+
+class FakeApi:
+    """
+    Stand-in for the departures API on a local port. Counts requests, answers with an ETag and
+    gzip, and can be slowed down or made to fail.
+    """
+
+    def __init__(self, payload, delay=0, status=200):
+        self.payload = payload # A payload, or a function of the aiohttp request returning one
+        self.delay = delay # Seconds before answering
+        self.status = status # Answered instead of the payload if not 200
+        self.requests = [] # path_qs of every request
+        self.connections = set() # Client addresses, one per TCP connection
+        self.url = None
+        self._runner = None
+
+    async def _handle(self, request):
+        self.requests.append(request.path_qs)
+        self.connections.add(request.transport.get_extra_info("peername"))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        payload = self.payload(request) if callable(self.payload) else self.payload
+        body = json.dumps(payload).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        # Compressed in the handler, like the API's proxy does for every response size
+        response = web.Response(body=body, content_type="application/json", headers={"ETag": etag}, zlib_executor_size=len(body) + 1)
+        response.enable_compression()
+        return response
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/stops/{stop_id}/departures", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = "http://127.0.0.1:{}".format(self._runner.addresses[0][1])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
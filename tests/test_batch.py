@@ -0,0 +1,41 @@
+"""Batch mode: the stops of one platform entry."""
+
+import asyncio
+
+from helpers import StubHass, install_stubs, load_sensor
+
+
+def setup_batch(tmp_path, config):
+    """Sets up the platform and returns the created sensors."""
+    async def run():
+        module = load_sensor()
+        hass = StubHass(str(tmp_path))
+        install_stubs(module, hass, None)
+        added = []
+        await module.async_setup_platform(hass, module.PLATFORM_SCHEMA({"platform": "bvg", **config}), added.extend)
+        await hass.bus.async_fire(module.EVENT_HOMEASSISTANT_STOP) # Stops the batch timer
+        return module, added
+
+    return asyncio.run(run())
+
+
+def test_stops_dont_inherit_direction_and_name(tmp_path):
+    module, sensors = setup_batch(tmp_path, {
+        "stop_id": "A", "direction_id": "X", "name": "Platform stop", "transit_type": "bus", "walking_distance": 3,
+        "stops": [{"stop_id": "B"}, {"stop_id": "C", "direction_id": "Y", "name": "C to Y", "walking_distance": 7}],
+    })
+    assert [(sensor.name, sensor.url) for sensor in sensors] == [
+        ("Platform stop", "https://v6.bvg.transport.rest/stops/A/departures?direction=X&duration=90"),
+        ("BVG B", "https://v6.bvg.transport.rest/stops/B/departures?duration=90"),
+        ("C to Y", "https://v6.bvg.transport.rest/stops/C/departures?direction=Y&duration=90"),
+    ]
+    # Options other than the stop's name and direction are shared
+    assert [(sensor._transit_type, sensor.min_due_in) for sensor in sensors] == [("bus", 3), ("bus", 3), ("bus", 7)]
+    assert not any(sensor.should_poll for sensor in sensors)
+
+
+def test_stops_without_platform_stop(tmp_path):
+    _, sensors = setup_batch(tmp_path, {"stops": [{"stop_id": "B", "direction_id": "Y"}]})
+    assert [(sensor.name, sensor.url) for sensor in sensors] == [
+        ("BVG B", "https://v6.bvg.transport.rest/stops/B/departures?direction=Y&duration=90"),
+    ]
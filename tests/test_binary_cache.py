@@ -0,0 +1,37 @@
+"""The binary cache format."""
+
+import asyncio
+
+import pytest
+
+from helpers import StubHass, create_sensor, load_sensor, make_payload
+
+
+def test_round_trip():
+    module = load_sensor()
+    timetable = module.parse_departures(make_payload(100))
+    timetable[0].trip_id = None
+    decoded = module.decode_departures(memoryview(module.encode_departures(timetable)))
+    fields = lambda departure: tuple(getattr(departure, name) for name in module.Departure.__slots__)
+    assert list(map(fields, decoded)) == list(map(fields, timetable))
+
+
+@pytest.mark.parametrize("size", [3, 20, 200, -1])
+def test_truncated_file_raises_value_error(size):
+    module = load_sensor()
+    encoded = module.encode_departures(module.parse_departures(make_payload(10)))
+    with pytest.raises(ValueError):
+        module.decode_departures(memoryview(encoded[:size]))
+
+
+def test_truncated_cache_file_is_reported_as_binary_cache_error(tmp_path, caplog):
+    async def run():
+        module = load_sensor()
+        encoded = module.encode_departures(module.parse_departures(make_payload(10)))
+        (tmp_path / "bvg_1.bin").write_bytes(encoded[:20])
+        sensor = create_sensor(module, StubHass(str(tmp_path)), stop_id="1", direction_id="2", cache_format="binary")
+        sensor.fetchDataFromFile()
+        assert sensor.data is None
+        assert "Error decoding binary cache file" in caplog.text
+
+    asyncio.run(run())
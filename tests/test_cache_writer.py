@@ -0,0 +1,49 @@
+"""Background writes of the cache file."""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from helpers import StubHass, install_stubs, load_sensor, make_payload
+
+
+def test_shutdown_flush_waits_for_a_slow_write(tmp_path, monkeypatch):
+    writing = []
+    overlaps = []
+    lock = threading.Lock()
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        with lock:
+            writing.append(fd)
+            overlaps.append(len(writing))
+        time.sleep(0.2) # A slow SD card
+        fsync(fd)
+        with lock:
+            writing.remove(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+
+    async def run():
+        module = load_sensor()
+        hass = StubHass(str(tmp_path))
+        install_stubs(module, hass, None)
+        path = str(tmp_path / "bvg_1.json")
+        writer = module.CacheWriter(hass, path, 60)
+        first, latest = make_payload(10, seed=1), make_payload(10, seed=2)
+
+        writer.schedule(first, None)
+        await asyncio.sleep(0.05) # The first write is in the executor
+        writer.schedule(latest, None) # Waits for the flush interval
+        await hass.bus.async_fire(module.EVENT_HOMEASSISTANT_STOP)
+        await hass.async_block_till_done()
+
+        assert max(overlaps) == 1
+        assert len(overlaps) == 2
+        with open(path, encoding="utf-8") as fd:
+            assert json.load(fd) == latest
+        assert os.listdir(tmp_path) == ["bvg_1.json"] # No temporary file left behind
+
+    asyncio.run(run())
@@ -0,0 +1,70 @@
+"""Diagnostics of the update stages."""
+
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload
+
+
+def test_bytes_received_are_compressed_size_and_304_parses_nothing(tmp_path):
+    async def run():
+        module = load_sensor()
+        payload = make_payload(200)
+        async with FakeApi(payload) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(str(tmp_path))
+            install_stubs(module, hass, session)
+            sensor = create_sensor(module, hass, stop_id="1", direction_id="2", diagnostics=True, endpoints=[api.url])
+
+            await sensor.async_update()
+            diagnostics = sensor.extra_state_attributes["diagnostics"]
+            assert 0 < diagnostics["bytes_received"] < len(json.dumps(payload)) / 3 # gzip
+            assert diagnostics["parse_time"] is not None
+
+            sensor._next_refresh = None
+            sensor._fetcher._fetched_at = None
+            await sensor.async_update() # Conditional request, answered with 304
+            diagnostics = sensor.extra_state_attributes["diagnostics"]
+            assert len(api.requests) == 2
+            assert diagnostics["bytes_received"] == 0
+            assert diagnostics["parse_time"] is None
+            assert diagnostics["fetch_time"] is not None
+
+    asyncio.run(run())
+
+
+def test_failed_request_and_open_breaker_replace_the_last_timings(tmp_path):
+    async def run():
+        module = load_sensor()
+        async with FakeApi(make_payload(200)) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(str(tmp_path))
+            install_stubs(module, hass, session)
+            sensor = create_sensor(module, hass, stop_id="1", direction_id="2", diagnostics=True, endpoints=[api.url])
+            await sensor.async_update()
+            assert sensor.extra_state_attributes["diagnostics"]["endpoint"] == api.url
+
+            api.status, api.delay = 503, 0.2
+            sensor._next_refresh = None
+            sensor._fetcher._fetched_at = None
+            await sensor.async_update()
+            diagnostics = sensor.extra_state_attributes["diagnostics"]
+            assert diagnostics["endpoint"] is None
+            assert diagnostics["fetch_time"] >= 200 # The time spent on the failed request
+            assert diagnostics["bytes_received"] == 0
+            assert diagnostics["parse_time"] is None
+            assert diagnostics["consecutive_failures"] == 1
+
+            sensor._fetcher.endpoints[0].breaker.state = module.BREAKER_OPEN
+            sensor._fetcher.endpoints[0].breaker._retry_at = time.monotonic() + 60
+            sensor._next_refresh = None
+            sensor._fetcher._fetched_at = None
+            await sensor.async_update()
+            diagnostics = sensor.extra_state_attributes["diagnostics"]
+            assert len(api.requests) == 2 # Paused by the breaker
+            assert diagnostics["endpoint"] is None and diagnostics["fetch_time"] is None
+            assert diagnostics["bytes_received"] == 0
+            assert diagnostics["consecutive_failures"] == 2
+
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+"""Hedged requests over two stand-in API servers answering with different latencies."""
+
+import asyncio
+import time
+
+import aiohttp
+
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload
+
+
+async def fetcher_on(tmp_path, session, *apis):
+    """Returns the module and the fetcher of a sensor on the given servers, hedging after 0.1 seconds."""
+    module = load_sensor()
+    module.HEDGE_DEFAULT_DELAY = 0.1
+    hass = StubHass(str(tmp_path))
+    install_stubs(module, hass, session)
+    sensor = create_sensor(module, hass, stop_id="900003201", walking_distance=0, endpoints=[api.url for api in apis])
+    return module, sensor._fetcher
+
+
+def test_losing_endpoint_keeps_its_latency(tmp_path):
+    async def run():
+        payload = make_payload(20)
+        async with FakeApi(payload, delay=0.25) as fast, FakeApi(payload, delay=0.5) as slow, aiohttp.ClientSession() as session:
+            _, fetcher = await fetcher_on(tmp_path, session, fast, slow)
+            primary, backup = fetcher.endpoints
+            for round in range(5):
+                await fetcher.fetch(session, 0)
+                assert fetcher.endpoint == fast.url
+                if round >= 1: # Both endpoints were tried once
+                    assert backup.latency() > primary.latency(), list(backup._latencies)
+            assert len(slow.requests) == 5 # Hedged every time, the slow endpoint never won
+
+    asyncio.run(run())
+
+
+def test_failed_endpoint_fails_over(tmp_path):
+    async def run():
+        payload = make_payload(20)
+        async with FakeApi(payload, status=503) as failing, FakeApi(payload) as backup, aiohttp.ClientSession() as session:
+            _, fetcher = await fetcher_on(tmp_path, session, failing, backup)
+            data, _ = await fetcher.fetch(session, 0)
+            assert data == payload
+            assert fetcher.endpoint == backup.url
+            assert fetcher.endpoints[0].breaker._failures == 1
+
+    asyncio.run(run())
+
+
+def test_cancelled_probe_keeps_backoff(tmp_path):
+    async def run():
+        payload = make_payload(20)
+        async with FakeApi(payload, delay=0.25) as healthy, FakeApi(payload, delay=0.5) as recovering, aiohttp.ClientSession() as session:
+            module, fetcher = await fetcher_on(tmp_path, session, healthy, recovering)
+            breaker = fetcher.endpoints[1].breaker
+            breaker.state, breaker._backoff, breaker._retry_at = module.BREAKER_OPEN, 60, time.monotonic() - 1
+
+            await fetcher.fetch(session, 0) # The recovering endpoint is probed by the hedge and loses
+            assert len(recovering.requests) == 1
+            assert fetcher.endpoint == healthy.url
+            assert breaker.state == module.BREAKER_OPEN
+            assert breaker._backoff == 60
+            assert breaker.allow_request() # Probed again by the next request
+
+    asyncio.run(run())
+
+
+def test_endpoint_answering_errors_is_demoted(tmp_path):
+    async def run():
+        payload = make_payload(20)
+        async with FakeApi(payload) as good, FakeApi(payload, status=404) as bad, aiohttp.ClientSession() as session:
+            module, fetcher = await fetcher_on(tmp_path, session, good, bad)
+            for _ in range(10):
+                await fetcher.fetch(session, 0)
+                assert fetcher.endpoint == good.url
+            assert len(good.requests) == 10
+            assert len(bad.requests) == 1 # Tried once, then ranked after the endpoint that answers
+            assert fetcher.endpoints[1].breaker.state == module.BREAKER_CLOSED # The host is up, the path is wrong
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+"""Sensors on the same stop share one request per interval, counted on a stand-in API server."""
+
+import asyncio
+
+import aiohttp
+import pytest
+
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload
+
+
+async def update_sensors(tmp_path, api, stops, concurrently=True):
+    """Creates a sensor per (direction_id, transit_type) and updates all of them once."""
+    module = load_sensor()
+    async with aiohttp.ClientSession() as session:
+        hass = StubHass(str(tmp_path))
+        install_stubs(module, hass, session)
+        sensors = [
+            create_sensor(
+                module, hass, stop_id="900003201", direction_id=direction_id, transit_type=transit_type,
+                walking_distance=0, endpoints=[api.url],
+            )
+            for direction_id, transit_type in stops
+        ]
+        if concurrently:
+            await asyncio.gather(*(sensor.async_update() for sensor in sensors))
+        else:
+            for sensor in sensors:
+                await sensor.async_update()
+        return sensors
+
+
+@pytest.mark.parametrize("count", [1, 5, 20])
+def test_sensors_on_one_stop_share_one_request(tmp_path, count):
+    async def run():
+        async with FakeApi(make_payload(100), delay=0.05) as api:
+            transit_types = ["bus", "tram", "suburban", None]
+            sensors = await update_sensors(tmp_path, api, [("900003200", transit_types[i % 4]) for i in range(count)])
+            assert len(api.requests) == 1
+            for sensor in sensors:
+                assert sensor.state != "n/a"
+                assert sensor.extra_state_attributes["connection_status"] == "online"
+
+    asyncio.run(run())
+
+
+def test_sensors_updated_one_after_another_share_one_request(tmp_path):
+    async def run():
+        async with FakeApi(make_payload(100)) as api:
+            await update_sensors(tmp_path, api, [("900003200", "bus"), ("900003200", "tram")], concurrently=False)
+            assert len(api.requests) == 1
+
+    asyncio.run(run())
+
+
+def test_one_request_per_direction(tmp_path):
+    async def run():
+        async with FakeApi(make_payload(100)) as api:
+            stops = [("900003200", "bus"), ("900003200", "tram"), ("900003100", None), ("900003100", "bus")]
+            await update_sensors(tmp_path, api, stops)
+            assert sorted(api.requests) == [
+                "/stops/900003201/departures?direction=900003100&duration=90",
+                "/stops/900003201/departures?direction=900003200&duration=90",
+            ]
+
+    asyncio.run(run())
+
+
+def test_failed_request_is_shared(tmp_path):
+    async def run():
+        async with FakeApi(make_payload(100), status=503) as api:
+            sensors = await update_sensors(tmp_path, api, [("900003200", None)] * 5)
+            assert len(api.requests) == 1
+            for sensor in sensors:
+                assert sensor.state == "n/a"
+                assert sensor.extra_state_attributes["connection_status"] == "offline"
+
+    asyncio.run(run())
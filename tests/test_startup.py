@@ -0,0 +1,59 @@
+"""Priming sensors from the cache file when they are added to Home Assistant."""
+
+import asyncio
+import logging
+
+import aiohttp
+
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload
+
+
+async def add_sensor(tmp_path, api, session):
+    """Creates a sensor on a freshly loaded module, as after a restart, and adds it to the stub hass."""
+    module = load_sensor()
+    hass = StubHass(str(tmp_path))
+    install_stubs(module, hass, session)
+    sensor = create_sensor(module, hass, stop_id="900003201", direction_id="900003200", walking_distance=0, endpoints=[api.url])
+    await sensor.async_added_to_hass()
+    return module, hass, sensor
+
+
+def test_fresh_install_primes_quietly_and_reports_offline(tmp_path, caplog):
+    async def run():
+        async with FakeApi(make_payload(100)) as api, aiohttp.ClientSession() as session:
+            with caplog.at_level(logging.DEBUG):
+                _, _, sensor = await add_sensor(tmp_path, api, session)
+            assert not [record for record in caplog.records if record.levelno >= logging.WARNING]
+            assert "No cache file yet" in caplog.text
+            assert sensor.state == "n/a"
+            assert sensor.extra_state_attributes["connection_status"] == "offline"
+            assert not api.requests # The first request is deferred
+
+            caplog.clear()
+            sensor._next_refresh = None
+            await sensor.async_update()
+            assert sensor.state != "n/a"
+            assert sensor.extra_state_attributes["connection_status"] == "online"
+            assert "re-established" not in caplog.text
+
+    asyncio.run(run())
+
+
+def test_restored_departures_are_not_reported_online(tmp_path):
+    async def run():
+        async with FakeApi(make_payload(100)) as api, aiohttp.ClientSession() as session:
+            module, hass, sensor = await add_sensor(tmp_path, api, session)
+            sensor._next_refresh = None
+            await sensor.async_update()
+            await hass.bus.async_fire(module.EVENT_HOMEASSISTANT_STOP) # Flushes the cache file
+
+            _, _, restarted = await add_sensor(tmp_path, api, session)
+            assert restarted.state == sensor.state
+            assert restarted.extra_state_attributes["connection_status"] == "offline"
+
+            restarted._next_refresh = None
+            await restarted.async_update()
+            assert restarted.extra_state_attributes["connection_status"] == "online"
+            assert len(api.requests) == 2
+
+    asyncio.run(run())
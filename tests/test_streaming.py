@@ -0,0 +1,73 @@
+"""Streaming parse and early stop."""
+
+import asyncio
+import json
+import time
+import types
+
+import aiohttp
+
+from helpers import FakeApi, StubHass, create_sensor, install_stubs, load_sensor, make_payload
+
+
+def test_stream_parser_handles_any_chunking():
+    module = load_sensor()
+    payload = make_payload(50)
+    payload["departures"][3]["direction"] = "Straße → Mitte"
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    for size in (1, 7, 1000, len(body)):
+        parser = module.DepartureStreamParser()
+        departures = []
+        for offset in range(0, len(body), size):
+            departures.extend(parser.feed(body[offset:offset + size]))
+        parser.close()
+        assert departures == payload["departures"]
+
+
+def test_streaming_stays_opt_in_per_sensor(tmp_path):
+    async def run():
+        module = load_sensor()
+        async with FakeApi(make_payload(600)) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(str(tmp_path))
+            install_stubs(module, hass, session)
+            options = dict(stop_id="1", direction_id="2", walking_distance=5, endpoints=[api.url])
+            streaming = create_sensor(module, hass, streaming=True, **options)
+            full = create_sensor(module, hass, **options)
+            await asyncio.gather(streaming.async_update(), full.async_update())
+            await hass.async_block_till_done()
+
+            assert streaming._fetcher is not full._fetcher
+            assert len(api.requests) == 2
+            assert len(full._fetcher._timetable) == 600
+            assert len(streaming._fetcher._timetable) < 600 # Stopped early
+            assert [(due_in, departure.trip_id) for due_in, departure in streaming.departures] == [
+                (due_in, departure.trip_id) for due_in, departure in full.departures
+            ]
+            # The partial window has its own cache file
+            assert full.file_name == "bvg_1.json" and streaming.file_name == "bvg_1_streaming.json"
+            with open(tmp_path / "bvg_1.json", encoding="utf-8") as fd:
+                assert len(json.load(fd)["departures"]) == 600
+
+    asyncio.run(run())
+
+
+def test_streaming_window_is_not_kept_by_not_modified_responses(tmp_path):
+    async def run():
+        module = load_sensor()
+        now = time.time()
+        module.time = types.SimpleNamespace(time=lambda: now, monotonic=lambda: now, perf_counter=time.perf_counter)
+        async with FakeApi(make_payload(900)) as api, aiohttp.ClientSession() as session:
+            hass = StubHass(str(tmp_path))
+            install_stubs(module, hass, session)
+            options = dict(stop_id="1", direction_id="2", transit_type="bus", walking_distance=5, endpoints=[api.url])
+            streaming = create_sensor(module, hass, streaming=True, **options)
+            full = create_sensor(module, hass, **options)
+            for _ in range(5):
+                await asyncio.gather(streaming.async_update(), full.async_update())
+                assert full.state != "n/a"
+                assert [due_in for due_in, _ in streaming.departures] == [due_in for due_in, _ in full.departures]
+                assert streaming._fetcher.parse_time is not None # A stopped stream is requested in full again
+                now += 300
+            await hass.async_block_till_done()
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+"""Selecting the departures of views from the index, checked against a brute-force selection."""
+
+import random
+
+import pytest
+
+from helpers import LINES, load_sensor, make_payload
+
+
+def brute_force(departures, view, now, min_due_in):
+    """The first departures of a view after now and min_due_in minutes from now, by a scan of the sorted timetable."""
+    selected = [
+        (int((departure.when - now) // 60), departure)
+        for departure in sorted(departures, key=lambda departure: departure.when)
+        if departure.when > now and departure.when >= now + min_due_in * 60 and view.matches(departure)
+    ]
+    return selected[:view.count]
+
+
+def random_case(rng, value):
+    return rng.choice([value, value.upper(), value.lower()])
+
+
+def random_view(module, rng):
+    """A view with up to three values per filter, in any case, some of them matching nothing."""
+    def values(choices):
+        if rng.random() < 0.4:
+            return None
+        return [random_case(rng, value) for value in rng.sample(choices, rng.randint(1, 3))]
+
+    names = sorted({line for line, _, _ in LINES})
+    products = sorted({product for _, product, _ in LINES}) + ["ferry"]
+    directions = sorted({direction for _, _, direction in LINES}) + ["Nowhere"]
+    return module.DepartureView(
+        "view", directions=values(directions), products=values(products), lines=values(names), count=rng.randint(1, 6)
+    )
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_select_matches_brute_force(seed):
+    module = load_sensor()
+    rng = random.Random(seed)
+    timetable = module.parse_departures(make_payload(rng.randint(0, 300), seed=seed, step=rng.choice([2, 6, 60])))
+    for departure in rng.sample(timetable, len(timetable) // 5): # Several departures due at the same second
+        departure.when = rng.choice(timetable).when
+    rng.shuffle(timetable) # The index sorts the departures itself
+    index = module.DepartureIndex(timetable)
+    whens = [departure.when for departure in timetable] or [0]
+
+    for _ in range(20):
+        view = random_view(module, rng)
+        now = rng.choice(whens) + rng.choice([-600, -1, 0, 1, 59, 600])
+        min_due_in = rng.choice([0, 1, 3, 10, 45])
+        expected = brute_force(timetable, view, now, min_due_in)
+        selected = index.select(view, now, min_due_in)
+        assert [(due_in, departure.trip_id, departure.when) for due_in, departure in selected] == [
+            (due_in, departure.trip_id, departure.when) for due_in, departure in expected
+        ]
+
+
+def test_departures_at_the_same_time_keep_the_api_order():
+    module = load_sensor()
+    timetable = module.parse_departures(make_payload(10))
+    for departure in timetable:
+        departure.when = timetable[0].when
+    view = module.DepartureView("all", count=10)
+    selected = module.DepartureIndex(timetable).select(view, timetable[0].when - 120, 0)
+    assert [departure for _, departure in selected] == timetable
+    assert {due_in for due_in, _ in selected} == {2}